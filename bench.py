@@ -0,0 +1,587 @@
+"""Micro-benchmarks for bot.py (needs the same requirements as the bot).
+
+    python bench.py ytdl [-n 50] [--url URL]
+    python bench.py db [-n 2000] [-c 50]
+    python bench.py checkin [-n 5000] [--users 3000]
+    python bench.py opus INPUT [--seconds 60]
+    python bench.py memory [--guilds 1000] [--tracks 50]
+    python bench.py suite [--guilds 50] [--commands 20] [--latency 0.05] [--track-seconds 0.5]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from dataclasses import dataclass
+
+import aiosqlite
+
+import bot
+
+
+def report(name: str, samples: list[float]):
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<12} n={len(samples):<6} mean={statistics.fmean(samples) * 1000:8.2f} ms  "
+          f"p50={p50 * 1000:8.2f} ms  p99={p99 * 1000:8.2f} ms")
+
+
+def timed(fn, n: int) -> list[float]:
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+# =========================
+# YoutubeDL construction vs pooled instance
+# =========================
+def bench_ytdl(args):
+    """Without --url only the per-call setup overhead is measured (no network)."""
+    def per_call():
+        with bot.ydl_class()(bot.YDL_OPTS) as ydl:
+            if args.url:
+                ydl.extract_info(args.url, download=False)
+
+    def pooled():
+        ydl = bot.get_ydl("full")
+        if args.url:
+            ydl.extract_info(args.url, download=False)
+
+    for name, fn in (("per-call", per_call), ("pooled", pooled)):
+        fn()  # warm-up (imports, first pooled instance)
+        report(name, timed(fn, args.n))
+
+
+# =========================
+# DB: connection per query vs shared connection
+# =========================
+async def _bench_db(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        database = bot.Database(path)
+        await database.start()
+        bot.database = database
+        await bot.init_db()
+        await database.executemany(
+            "INSERT INTO music_channels (guild_id, channel_id) VALUES (?, ?)",
+            [(g, g * 10) for g in range(1000)],
+        )
+
+        async def per_call(gid: int):
+            async with aiosqlite.connect(path) as db:
+                cur = await db.execute("SELECT channel_id FROM music_channels WHERE guild_id = ?", (gid,))
+                await cur.fetchone()
+
+        async def shared(gid: int):
+            await database.fetchone("SELECT channel_id FROM music_channels WHERE guild_id = ?", (gid,))
+
+        for name, fn in (("per-call", per_call), ("shared", shared)):
+            sem = asyncio.Semaphore(args.c)
+            samples = []
+
+            async def one(i: int):
+                async with sem:
+                    t0 = time.perf_counter()
+                    await fn(i % 1000)
+                    samples.append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.n)))
+            elapsed = time.perf_counter() - t0
+            report(name, samples)
+            print(f"{'':<12} throughput={args.n / elapsed:,.0f} queries/s at concurrency {args.c}")
+
+        await database.close()
+
+
+def bench_db(args):
+    asyncio.run(_bench_db(args))
+
+
+# =========================
+# /checkin burst: transaction per check-in vs write-behind batches
+# =========================
+async def _bench_checkin(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = bot.Database(os.path.join(tmp, "bench.db"))
+        await database.start()
+        bot.database = database
+        await bot.init_db()
+        day, month = bot.utc_today_str(), bot.utc_month_str()
+
+        async def direct(gid: int, uid: int) -> bool:
+            async with database.transaction() as db:
+                return await bot.apply_checkin(db, gid, uid, day, month)
+
+        writer = bot.CheckinWriter(bot.CHECKIN_BATCH_MS, bot.CHECKIN_BATCH_MAX)
+
+        async def batched(gid: int, uid: int) -> bool:
+            return await writer.submit(gid, uid, day, month)
+
+        for gid, (name, fn) in enumerate((("direct", direct), ("write-behind", batched)), start=1):
+            samples = []
+
+            async def one(i: int) -> bool:
+                t0 = time.perf_counter()
+                is_new = await fn(gid, i % args.users)
+                samples.append(time.perf_counter() - t0)
+                return is_new
+
+            t0 = time.perf_counter()
+            results = await asyncio.gather(*(one(i) for i in range(args.n)))
+            elapsed = time.perf_counter() - t0
+            report(name, samples)
+            print(f"{'':<12} {args.n / elapsed:,.0f} check-ins/s, new={sum(results)} "
+                  f"(expected {min(args.n, args.users)})")
+        print(f"write-behind used {writer.batches} transactions")
+
+        await database.close()
+
+
+def bench_checkin(args):
+    asyncio.run(_bench_checkin(args))
+
+
+# =========================
+# Opus passthrough vs PCM decode + libopus encode
+# =========================
+def _cpu_seconds() -> float:
+    self_ = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # FFmpeg, once reaped by cleanup()
+    return self_.ru_utime + self_.ru_stime + children.ru_utime + children.ru_stime
+
+
+def bench_opus(args):
+    """INPUT is a local webm/opus file or a stream URL (e.g. a resolved googlevideo URL)."""
+    import discord
+
+    if not discord.opus.is_loaded():
+        discord.opus._load_default()
+    local = None if args.input.startswith(("http://", "https://")) else args.input
+    frames_wanted = int(args.seconds * 50)  # 20 ms frames
+
+    def run(codec: str):
+        track = bot.Track(title="bench", webpage_url="", stream_url=args.input, codec=codec)
+        source = bot.make_source(track, local)
+        encoder = None if source.is_opus() else discord.opus.Encoder()
+        cpu0, t0 = _cpu_seconds(), time.perf_counter()
+        frames = 0
+        while frames < frames_wanted:
+            data = source.read()
+            if not data:
+                break
+            if encoder:
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)  # what AudioPlayer does for PCM
+            frames += 1
+        source.cleanup()
+        cpu, wall = _cpu_seconds() - cpu0, time.perf_counter() - t0
+        minutes = frames / 50 / 60
+        name = "passthrough" if encoder is None else "pcm+encode"
+        print(f"{name:<12} audio={minutes * 60:6.1f}s  cpu={cpu:6.2f}s  "
+              f"cpu/min-audio={cpu / minutes if minutes else 0:6.2f}s  wall={wall:6.2f}s")
+
+    run("opus")
+    run("")  # unknown codec -> PCM path
+
+
+# =========================
+# Memory: bytes per guild state / queued track (tracemalloc)
+# =========================
+@dataclass
+class DictTrack:
+    """Track as it was before __slots__."""
+    title: str
+    webpage_url: str
+    stream_url: str = ""
+    video_id: str | None = None
+    duration: int | None = None
+    codec: str | None = None
+
+
+class DictState:
+    """GuildMusicState with the same fields, minus __slots__."""
+
+    def __init__(self):
+        self.queue = deque()
+        self.text_channel_id = None
+        self.radio_pos = 0
+        self.current_track = None
+        self.loop = False
+        self.autoplay = True
+        self.now_playing_channel_id = None
+        self.now_playing_msg_id = None
+        self.prefetch_task = None
+        self.prefetched = None
+        self.track_ended_at = None
+        self.radio_batch = bot.RADIO_BATCH
+        self.refill_task = None
+        self.last_active = time.monotonic()
+        self.history = None
+
+
+def traced(build) -> tuple[int, object]:
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used, kept
+
+
+def bench_memory(args):
+    def make_tracks(cls, g: int, n: int) -> list:
+        return [cls(title=f"song {g}-{i} (official audio)", webpage_url=f"https://www.youtube.com/watch?v={g:05d}{i:06d}",
+                     video_id=f"{g:05d}{i:06d}", duration=215) for i in range(n)]
+
+    for name, track_cls, state_cls in (("before", DictTrack, DictState), ("after", bot.Track, bot.GuildMusicState)):
+        state_bytes, _ = traced(lambda: {g: state_cls() for g in range(args.guilds)})
+        track_bytes, _ = traced(lambda: [make_tracks(track_cls, 0, args.tracks) for _ in range(args.guilds // 10 or 1)])
+        tracks = (args.guilds // 10 or 1) * args.tracks
+        print(f"{name:<7} guild state={state_bytes / args.guilds:7.0f} B  queued track={track_bytes / tracks:6.0f} B")
+
+    # idle eviction returns the per-guild memory
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for g in range(args.guilds):
+        bot.get_state(g).queue.extend(make_tracks(bot.Track, g, args.tracks))
+    held = tracemalloc.get_traced_memory()[0] - base
+    bot.IDLE_EVICT_SECONDS = 0
+    evicted = bot.evict_idle_guilds()
+    left = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f"evict   {evicted} guilds: {held / 1e6:.2f} MB held -> {left / 1e6:.2f} MB after eviction")
+
+
+# =========================
+# Offline suite: fake yt-dlp, fake voice, fake gateway objects
+# =========================
+class FakeYDL:
+    """Stands in for yt_dlp.YoutubeDL (patched via bot.ydl_class); extract_info sleeps `latency`."""
+    latency = 0.05
+    track_seconds = 0.5
+    calls = 0
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+
+    @staticmethod
+    def _vid(text: str) -> str:
+        return hashlib.md5(text.encode()).hexdigest()[:11]
+
+    def _video(self, vid: str, title: str) -> dict:
+        return {
+            "id": vid,
+            "title": title,
+            "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+            "url": f"https://rr1---sn-fake.googlevideo.com/videoplayback?id={vid}&expire={int(time.time()) + 21600}",
+            "duration": self.track_seconds,
+            "acodec": "opus",
+        }
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True) -> dict:
+        FakeYDL.calls += 1
+        time.sleep(self.latency)
+        if url.startswith("ytsearch1:"):
+            query = url.split(":", 1)[1]
+            return {"entries": [{"id": self._vid(query), "title": query, "duration": self.track_seconds}]}
+        vid = bot.youtube_video_id(url) or self._vid(url)
+        if self.opts.get("extract_flat"):
+            return {"title": f"video {vid}", "related_videos": [{"id": self._vid(vid + "/related")}]}
+        return self._video(vid, f"video {vid}")
+
+    def close(self):
+        pass
+
+
+class FakeSource:
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """Plays each source for `track_seconds`, then calls `after` from another thread like discord.py."""
+
+    def __init__(self, channel, track_seconds: float):
+        self.channel = channel
+        self.track_seconds = track_seconds
+        self._timer: threading.Timer | None = None
+        self._after = None
+        self._paused = False
+        self.plays: list[float] = []
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._timer is not None and not self._paused
+
+    def is_paused(self):
+        return self._timer is not None and self._paused
+
+    def play(self, source, *, after=None):
+        self.plays.append(time.perf_counter())
+        self._after = after
+        self._timer = threading.Timer(self.track_seconds, self._finish, args=(after,))
+        self._timer.start()
+
+    def _finish(self, after):
+        self._timer = None
+        if after:
+            after(None)
+
+    def stop(self):
+        timer, self._timer = self._timer, None
+        if timer:
+            timer.cancel()
+            threading.Thread(target=self._finish, args=(self._after,)).start()  # discord.py also calls `after` on stop
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+
+
+def make_fakes():
+    """Gateway objects built without a connection (discord.py classes, __init__ bypassed)."""
+    import discord
+
+    class FakeMessage:
+        id = 0
+
+        async def delete(self):
+            pass
+
+        async def edit(self, **kwargs):
+            return self
+
+    class FakeTextChannel(discord.TextChannel):
+        def __init__(self, channel_id: int):
+            self.id = channel_id
+            self.sent = 0
+
+        async def send(self, *args, **kwargs):
+            self.sent += 1
+            return FakeMessage()
+
+    class FakeVoiceChannel:
+        def __init__(self, channel_id: int):
+            self.id = channel_id
+            self.members = []
+
+    class FakeVoiceState:
+        def __init__(self, channel):
+            self.channel = channel
+
+    class FakeMember(discord.Member):
+        id = 0
+        bot = False
+        mention = "<@1>"
+        voice = None
+
+        def __init__(self, user_id: int, guild, voice_channel):
+            self.id = user_id
+            self.guild = guild
+            self.voice = FakeVoiceState(voice_channel)
+
+    class FakeGuild:
+        def __init__(self, guild_id: int, track_seconds: float):
+            self.id = guild_id
+            self.name = f"guild {guild_id}"
+            self.text = FakeTextChannel(guild_id * 10 + 1)
+            self.voice = FakeVoiceChannel(guild_id * 10 + 2)
+            self.voice_client = FakeVoiceClient(self.voice, track_seconds)
+            self.system_channel = self.text
+            self.text_channels = [self.text]
+            self.member = FakeMember(guild_id * 10 + 3, self, self.voice)
+
+        def get_channel(self, channel_id: int):
+            return self.text if channel_id == self.text.id else None
+
+        def get_member(self, user_id: int):
+            return self.member if user_id == self.member.id else None
+
+    class FakeUserMessage:
+        def __init__(self, guild, content: str):
+            self.guild = guild
+            self.author = guild.member
+            self.channel = guild.text
+            self.content = content
+
+        async def delete(self):
+            pass
+
+    class _Response:
+        async def defer(self, **kwargs):
+            pass
+
+        async def send_message(self, *args, **kwargs):
+            pass
+
+    class _Followup:
+        async def send(self, *args, **kwargs):
+            return FakeMessage()
+
+    class FakeInteraction:
+        def __init__(self, guild):
+            self.guild = guild
+            self.user = guild.member
+            self.channel_id = guild.text.id
+            self.response = _Response()
+            self.followup = _Followup()
+
+    return FakeGuild, FakeUserMessage, FakeInteraction
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def _bench_suite(args):
+    FakeYDL.latency = args.latency
+    FakeYDL.track_seconds = args.track_seconds
+    bot.ydl_class = lambda: FakeYDL
+    bot.make_source = lambda track, local_path=None: FakeSource()
+    FakeGuild, FakeUserMessage, FakeInteraction = make_fakes()
+
+    guilds = {gid: FakeGuild(gid, args.track_seconds) for gid in range(1, args.guilds + 1)}
+    bot.bot.get_guild = guilds.get
+
+    async def no_commands(message):
+        pass
+
+    bot.bot.process_commands = no_commands
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = bot.Database(os.path.join(tmp, "bench.db"))
+        await database.start()
+        bot.database = database
+        await bot.init_db()
+        for gid, guild in guilds.items():
+            bot.guild_configs[gid] = bot.GuildConfig(music_channel_id=guild.text.id)
+            bot.radio_lists[gid] = tuple(f"radio song {i}" for i in range(10))
+        bot.playback_stats["gaps"].clear()
+
+        rng = random.Random(1)
+        pool = [f"song {i}" for i in range(args.guilds * 4)]  # shared across guilds -> cache hits
+        rss0 = rss_mb()
+
+        # 1) radio_fill_queue on every guild at once
+        samples = []
+
+        async def fill(guild):
+            t0 = time.perf_counter()
+            await bot.radio_fill_queue(guild, count=3)
+            samples.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(fill(g) for g in guilds.values()))
+        report("radio_fill", samples)
+        for g in guilds.values():
+            bot.get_state(g.id).queue.clear()
+
+        # 2) mixed on_message / /play traffic while the players run
+        samples = []
+
+        async def user(guild):
+            for i in range(args.commands):
+                query = rng.choice(pool)
+                t0 = time.perf_counter()
+                if i % 2:
+                    await bot.on_message(FakeUserMessage(guild, query))
+                else:
+                    await bot.play.callback(FakeInteraction(guild), query)
+                samples.append(time.perf_counter() - t0)
+                await asyncio.sleep(rng.uniform(0, args.track_seconds))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user(g) for g in guilds.values()))
+        elapsed = time.perf_counter() - t0
+        report("commands", samples)
+        print(f"{'':<12} throughput={len(samples) / elapsed:,.1f} commands/s over {args.guilds} guilds")
+
+        # let the queues drain a bit so inter-track gaps are measured
+        await asyncio.sleep(args.track_seconds * 4)
+        gaps = list(bot.playback_stats["gaps"])
+        if gaps:
+            report("track_gap", gaps)
+        plays = sum(len(g.voice_client.plays) for g in guilds.values())
+        print(f"tracks started={plays}  yt-dlp calls={FakeYDL.calls}  "
+              f"cache={bot.extract_cache.stats()}")
+        print(f"rss={rss_mb():.1f} MB (start {rss0:.1f} MB)")
+
+        for g in guilds.values():
+            bot.get_player(g.id).post("stop", False)
+        await asyncio.sleep(0.1)
+        await database.close()
+
+
+def bench_suite(args):
+    asyncio.run(_bench_suite(args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("ytdl", help="YoutubeDL per-call construction vs pool")
+    p.add_argument("-n", type=int, default=50)
+    p.add_argument("--url", default="", help="also run a real extraction per iteration")
+    p.set_defaults(func=bench_ytdl)
+
+    p = sub.add_parser("db", help="aiosqlite connect-per-query vs shared connection")
+    p.add_argument("-n", type=int, default=2000, help="queries")
+    p.add_argument("-c", type=int, default=50, help="concurrency")
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("checkin", help="simulated /checkin burst, p50/p99 latency")
+    p.add_argument("-n", type=int, default=5000, help="check-ins fired at once")
+    p.add_argument("--users", type=int, default=3000, help="distinct users (the rest are duplicates)")
+    p.set_defaults(func=bench_checkin)
+
+    p = sub.add_parser("opus", help="CPU per minute of audio: Opus passthrough vs PCM")
+    p.add_argument("input", help="local webm/opus file or stream URL")
+    p.add_argument("--seconds", type=float, default=60)
+    p.set_defaults(func=bench_opus)
+
+    p = sub.add_parser("memory", help="bytes per guild state and queued track, before/after __slots__")
+    p.add_argument("--guilds", type=int, default=1000)
+    p.add_argument("--tracks", type=int, default=50, help="queued tracks per guild")
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("suite", help="offline end-to-end run: fake yt-dlp, voice and gateway")
+    p.add_argument("--guilds", type=int, default=50)
+    p.add_argument("--commands", type=int, default=20, help="song requests per guild")
+    p.add_argument("--latency", type=float, default=0.05, help="fake yt-dlp seconds per call")
+    p.add_argument("--track-seconds", type=float, default=0.5, help="fake track length")
+    p.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,31 @@
+import time
+T_START = time.perf_counter()  # startup phases are measured from here
+
 import os
+import re
+import json
+import hashlib
+import signal
 import asyncio
+import threading
+import weakref
 import datetime as dt
-from dataclasses import dataclass
-from collections import deque
+from dataclasses import dataclass, replace
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 
+import aiohttp
 import aiosqlite
 from dotenv import load_dotenv
-import yt_dlp
+# yt_dlp is imported lazily (ydl_class): its extractor registry costs seconds of startup
+if TYPE_CHECKING:
+    import yt_dlp
 
 # =========================
 # ENV
@@ -26,6 +41,44 @@ DRIVE_FILE_ID = "1ZIsyyKutbOVSeeXSWbJgwVY1zOIRVjL2"
 WELCOME_IMAGE_URL = f"https://drive.google.com/uc?export=view&id={DRIVE_FILE_ID}"
 
 DB_PATH = "bot_data.db"
+CHECKIN_BATCH_MS = float(os.getenv("CHECKIN_BATCH_MS", "5"))     # write-behind window for /checkin
+CHECKIN_BATCH_MAX = int(os.getenv("CHECKIN_BATCH_MAX", "500"))
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-4000",   # KiB; the VM only has 256 MB
+    "PRAGMA busy_timeout=5000",  # other cluster processes may hold the write lock
+)
+
+# =========================
+# Startup timing
+# =========================
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+startup_phases: dict[str, float] = {}  # phase -> seconds since T_START (first occurrence only)
+
+def mark_startup(phase: str):
+    if phase not in startup_phases:
+        startup_phases[phase] = round(time.perf_counter() - T_START, 3)
+        print(f"[startup] {phase} at {startup_phases[phase]:.2f}s")
+
+# =========================
+# Sharding / clusters
+# =========================
+CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", "1"))   # >1: `python bot.py` becomes a launcher
+CLUSTER_INDEX = int(os.getenv("CLUSTER_INDEX", "0"))   # set by the launcher for each child
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", str(CLUSTER_COUNT if CLUSTER_COUNT > 1 else 0)))  # 0 = no sharding
+SHARD_IDS = tuple(int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()) or None  # None = all
+
+def cluster_shards(index: int) -> tuple[int, ...]:
+    return tuple(range(index, SHARD_COUNT, CLUSTER_COUNT))
+
+def owns_guild(guild_id: int) -> bool:
+    """True if this process's shards receive the guild's events (Discord routes by (id >> 22) % shards)."""
+    if not SHARD_COUNT or SHARD_IDS is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
 
 # =========================
 # 24/7 Toggle
@@ -33,10 +86,127 @@ DB_PATH = "bot_data.db"
 always_on_guilds: set[int] = set()
 
 # =========================
-# DB init
+# Metrics (Prometheus text format, served on /metrics)
+# =========================
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self, name: str, doc: str, label: str = "", buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = buckets
+        self._series: dict[str, list] = {}  # label value -> [count per bucket..., +Inf, sum]
+
+    def observe(self, value: float, label_value: str = ""):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for label_value, series in self._series.items():
+            base = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), series):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {cumulative}')
+            tags = f"{{{base.rstrip(',')}}}" if base else ""
+            lines.append(f"{self.name}_sum{tags} {series[-1]}")
+            lines.append(f"{self.name}_count{tags} {cumulative}")
+        return lines
+
+extract_latency = Histogram("musicbot_extract_seconds", "yt-dlp extraction latency incl. queue wait", "source")
+gap_histogram = Histogram("musicbot_inter_track_gap_seconds", "Silence between track end and next vc.play")
+db_latency = Histogram("musicbot_db_seconds", "SQLite query / transaction latency", "op")
+loop_lag = Histogram("musicbot_event_loop_lag_seconds", "Event loop scheduling delay")
+LOOP_LAG_INTERVAL = 0.5
+
+async def monitor_loop_lag():
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, time.perf_counter() - t0 - LOOP_LAG_INTERVAL))
+
+# =========================
+# DB
 # =========================
+class Database:
+    """One long-lived aiosqlite connection (one background thread) shared by every DB helper.
+
+    sqlite3 keeps compiled statements in a per-connection cache, so reusing the
+    connection also reuses prepared statements. Writes are serialized by a lock so
+    one helper's commit never flushes another helper's half-done transaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+
+    async def start(self):
+        if self.conn is not None:
+            return
+        # IMMEDIATE: take the write lock at the first write, so two processes never
+        # deadlock upgrading read locks inside a transaction (busy_timeout then waits)
+        self.conn = await aiosqlite.connect(self.path, cached_statements=256, isolation_level="IMMEDIATE")
+        self.conn.row_factory = aiosqlite.Row
+        for pragma in DB_PRAGMAS:
+            await self.conn.execute(pragma)
+
+    async def close(self):
+        if self.conn is None:
+            return
+        async with self._write_lock:
+            await self.conn.close()
+            self.conn = None
+
+    async def fetchone(self, sql: str, params=()):
+        t0 = time.perf_counter()
+        async with self.conn.execute(sql, params) as cur:
+            row = await cur.fetchone()
+        db_latency.observe(time.perf_counter() - t0, "read")
+        return row
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        t0 = time.perf_counter()
+        async with self.conn.execute(sql, params) as cur:
+            rows = await cur.fetchall()
+        db_latency.observe(time.perf_counter() - t0, "read")
+        return rows
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._write_lock:
+            t0 = time.perf_counter()
+            try:
+                yield self.conn
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+            db_latency.observe(time.perf_counter() - t0, "write")
+
+    async def execute(self, sql: str, params=()) -> int:
+        async with self.transaction() as conn:
+            cur = await conn.execute(sql, params)
+            return cur.rowcount
+
+    async def executemany(self, sql: str, rows) -> None:
+        async with self.transaction() as conn:
+            await conn.executemany(sql, rows)
+
+database = Database(DB_PATH)
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with database.transaction() as db:
         await db.execute("""
         CREATE TABLE IF NOT EXISTS checkins (
             guild_id INTEGER NOT NULL,
@@ -60,7 +230,117 @@ async def init_db():
             channel_id INTEGER NOT NULL
         );
         """)
-        await db.commit()
+        # ✅ search/URL -> video metadata (stream URLs are short-lived, never stored)
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS track_cache (
+            key         TEXT    PRIMARY KEY,
+            video_id    TEXT,
+            title       TEXT    NOT NULL,
+            webpage_url TEXT    NOT NULL,
+            duration    INTEGER,
+            last_used   REAL    NOT NULL
+        );
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_track_cache_last_used ON track_cache (last_used)")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id    INTEGER PRIMARY KEY,
+            always_on   INTEGER NOT NULL DEFAULT 0,
+            autoplay    INTEGER NOT NULL DEFAULT 1,
+            radio_batch INTEGER
+        );
+        """)
+        # ✅ leaderboard / streaks, maintained in the same transaction as each check-in
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS checkin_counts (
+            guild_id       INTEGER NOT NULL,
+            month          TEXT    NOT NULL,
+            user_id        INTEGER NOT NULL,
+            count          INTEGER NOT NULL,
+            current_streak INTEGER NOT NULL,
+            longest_streak INTEGER NOT NULL,
+            last_date      TEXT    NOT NULL,
+            PRIMARY KEY (guild_id, month, user_id)
+        );
+        """)
+        await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_checkin_counts_rank
+            ON checkin_counts (guild_id, month, count DESC, user_id)
+        """)
+        # ✅ playback sessions, rewritten by SessionStore and restored after a restart
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            guild_id         INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER NOT NULL,
+            text_channel_id  INTEGER,
+            radio_pos        INTEGER NOT NULL,
+            loop             INTEGER NOT NULL,
+            queue            TEXT    NOT NULL,
+            updated_at       REAL    NOT NULL
+        );
+        """)
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        """)
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS audio_cache (
+            video_id  TEXT    PRIMARY KEY,
+            size      INTEGER NOT NULL,
+            last_used REAL    NOT NULL
+        );
+        """)
+        await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_checkin_counts_user
+            ON checkin_counts (guild_id, user_id, last_date, current_streak, longest_streak)
+        """)
+
+    await migrate_db()
+
+async def migrate_db():
+    (version,) = await database.fetchone("PRAGMA user_version")
+    if version < 1:
+        await backfill_checkin_counts()
+        await database.execute("PRAGMA user_version = 1")
+        print("[db] migrated to schema version 1 (checkin_counts)")
+    if version < 2:
+        await database.execute("ALTER TABLE audio_cache ADD COLUMN codec TEXT")
+        await database.execute("PRAGMA user_version = 2")
+        print("[db] migrated to schema version 2 (audio_cache.codec)")
+    if version < 3:
+        async with database.transaction() as db:
+            await db.execute("ALTER TABLE guild_settings ADD COLUMN radio_pos INTEGER NOT NULL DEFAULT 0")
+            await db.execute("ALTER TABLE guild_settings ADD COLUMN loop INTEGER NOT NULL DEFAULT 0")
+            await db.execute("PRAGMA user_version = 3")
+        print("[db] migrated to schema version 3 (guild_settings.radio_pos / loop)")
+
+async def backfill_checkin_counts():
+    rows = await database.fetchall(
+        "SELECT guild_id, user_id, date, month FROM checkins ORDER BY guild_id, user_id, date"
+    )
+    counts: dict[tuple[int, str, int], list] = {}
+    prev_key, prev_date, current, longest = None, None, 0, 0
+    for gid, uid, day, month in rows:
+        d = dt.date.fromisoformat(day)
+        same_user = (gid, uid) == prev_key
+        if not same_user:
+            longest = 0
+        current = current + 1 if same_user and d - prev_date == dt.timedelta(days=1) else 1
+        longest = max(longest, current)
+        entry = counts.setdefault((gid, month, uid), [0, 0, 0, ""])
+        entry[0] += 1
+        entry[1:] = [current, longest, day]
+        prev_key, prev_date = (gid, uid), d
+
+    async with database.transaction() as db:
+        await db.execute("DELETE FROM checkin_counts")
+        await db.executemany(
+            "INSERT INTO checkin_counts (guild_id, month, user_id, count, current_streak, longest_streak, last_date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(gid, month, uid, *entry) for (gid, month, uid), entry in counts.items()],
+        )
 
 def utc_today_str():
     return dt.datetime.utcnow().date().isoformat()
@@ -69,6 +349,85 @@ def utc_month_str():
     d = dt.datetime.utcnow().date()
     return f"{d.year:04d}-{d.month:02d}"
 
+async def apply_checkin(db: aiosqlite.Connection, guild_id: int, user_id: int, day: str, month: str) -> bool:
+    """Insert a check-in and update checkin_counts; False if already checked in. Call inside a transaction."""
+    cur = await db.execute(
+        "INSERT OR IGNORE INTO checkins (guild_id, user_id, date, month) VALUES (?, ?, ?, ?)",
+        (guild_id, user_id, day, month),
+    )
+    if cur.rowcount == 0:
+        return False
+
+    cur = await db.execute("""
+        SELECT last_date, current_streak, longest_streak FROM checkin_counts
+        WHERE guild_id = ? AND user_id = ?
+        ORDER BY last_date DESC LIMIT 1
+    """, (guild_id, user_id))
+    prev = await cur.fetchone()
+    yesterday = (dt.date.fromisoformat(day) - dt.timedelta(days=1)).isoformat()
+    current = prev[1] + 1 if prev and prev[0] == yesterday else 1
+    longest = max(current, prev[2] if prev else 0)
+
+    await db.execute("""
+        INSERT INTO checkin_counts (guild_id, month, user_id, count, current_streak, longest_streak, last_date)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (guild_id, month, user_id) DO UPDATE SET
+            count = count + 1,
+            current_streak = excluded.current_streak,
+            longest_streak = excluded.longest_streak,
+            last_date = excluded.last_date
+    """, (guild_id, month, user_id, current, longest, day))
+    return True
+
+class CheckinWriter:
+    """Write-behind queue for /checkin: bursts are grouped into one transaction every few ms.
+
+    Each caller still gets its own answer (True = new row, False = already checked in).
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: list[tuple[tuple[int, int, str, str], asyncio.Future]] = []
+        self._task: asyncio.Task | None = None
+        self.batches = 0
+
+    async def submit(self, guild_id: int, user_id: int, day: str, month: str) -> bool:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append(((guild_id, user_id, day, month), fut))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+        return await fut
+
+    async def _flush_loop(self):
+        await asyncio.sleep(self.window)
+        # whatever arrives while a batch is being written goes into the next one
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            await self._write(batch)
+
+    async def _write(self, batch):
+        try:
+            async with database.transaction() as db:
+                results = [await apply_checkin(db, *args) for args, _ in batch]
+        except Exception as e:
+            print(f"[checkin] batch of {len(batch)} failed: {e}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        for (_, fut), is_new in zip(batch, results):
+            if not fut.done():
+                fut.set_result(is_new)
+
+    async def close(self):
+        if self._task and not self._task.done():
+            await self._task
+
+checkin_writer = CheckinWriter(CHECKIN_BATCH_MS, CHECKIN_BATCH_MAX)
+
 # =========================
 # Music config
 # =========================
@@ -88,6 +447,71 @@ YDL_OPTS = {
 if os.path.exists("/app/cookies.txt"):
     YDL_OPTS["cookiefile"] = "/app/cookies.txt"
 
+# metadata-only lookups (search -> id/title, related videos)
+FLAT_YDL_OPTS = {
+    "quiet": True,
+    "noplaylist": True,
+    "extract_flat": True,
+}
+if "cookiefile" in YDL_OPTS:
+    FLAT_YDL_OPTS["cookiefile"] = YDL_OPTS["cookiefile"]
+
+# playlists / mixes: entries are read page by page as id + title only
+PLAYLIST_YDL_OPTS = {
+    "quiet": True,
+    "extract_flat": "in_playlist",
+    "lazy_playlist": True,
+}
+if "cookiefile" in YDL_OPTS:
+    PLAYLIST_YDL_OPTS["cookiefile"] = YDL_OPTS["cookiefile"]
+PLAYLIST_MAX = int(os.getenv("PLAYLIST_MAX", "100"))  # tracks queued per import; 0 = single video only
+PLAYLIST_PAGE = 25                                    # entries handed to the queue at a time
+
+# ✅ YoutubeDL instances are reused per worker thread, then recycled
+YDL_RECYCLE_USES = int(os.getenv("YDL_RECYCLE_USES", "200"))
+YDL_RECYCLE_SECONDS = int(os.getenv("YDL_RECYCLE_SECONDS", "3600"))
+
+# ✅ dedicated yt-dlp threads (1 vCPU / 256 MB: keep this small)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+
+# ✅ gapless: resolve the next track while the current one plays
+PREFETCH_FFMPEG = os.getenv("PREFETCH_FFMPEG", "0") == "1"   # also spawn FFmpeg early
+PREFETCH_LEAD = int(os.getenv("PREFETCH_LEAD", "15"))         # seconds before the end
+PREFETCH_POLL = 5.0  # seconds between pause checks while waiting to spawn FFmpeg
+
+# ✅ radio refill: resolve entries concurrently, start before the queue runs dry
+RADIO_BATCH = int(os.getenv("RADIO_BATCH", "3"))                       # default per-guild batch
+RADIO_FILL_CONCURRENCY = int(os.getenv("RADIO_FILL_CONCURRENCY", "3"))
+RADIO_LOW_WATER = int(os.getenv("RADIO_LOW_WATER", "1"))               # refill when queue < this
+
+# ✅ autoplay: related lists per video (YouTube mix), never repeat recently played videos
+AUTOPLAY_HISTORY = int(os.getenv("AUTOPLAY_HISTORY", "50"))        # recent video ids per guild
+RELATED_CACHE_SIZE = int(os.getenv("RELATED_CACHE_SIZE", "512"))   # videos with a cached related list
+RELATED_CACHE_TTL = int(os.getenv("RELATED_CACHE_TTL", "21600"))
+RELATED_CANDIDATES = 25                                            # mix entries kept per video
+
+# ✅ optional local audio cache for repeat plays (disabled when AUDIO_CACHE_DIR is empty)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+AUDIO_CACHE_MAX_DURATION = int(os.getenv("AUDIO_CACHE_MAX_DURATION", "900"))  # skip long mixes / live
+AUDIO_CACHE_TOUCH_BATCH = 50  # pending last_used bumps before they are written
+
+# ✅ send Opus streams to Discord as-is (no FFmpeg decode + libopus re-encode)
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "1") == "1"
+
+PLAYER_STEP_TIMEOUT = int(os.getenv("PLAYER_STEP_TIMEOUT", "60"))  # max seconds per player transition
+PLAYER_RETRY_MIN = 2.0    # first retry after a failed transition (doubles per failure)
+PLAYER_RETRY_MAX = 120.0
+
+# ✅ sessions survive restarts (queue + voice channel per guild)
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "10"))      # at most one write per interval
+SESSION_RESTORE_CONCURRENCY = int(os.getenv("SESSION_RESTORE_CONCURRENCY", "5"))
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", "21600"))                # older sessions are not resumed
+
+# ✅ memory bounds (the VM only has 256 MB)
+IDLE_EVICT_SECONDS = int(os.getenv("IDLE_EVICT_SECONDS", "1800"))  # drop idle guild state; 0 = never
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "200"))                     # queued tracks per guild
+
 FFMPEG_OPTS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
     "options": "-vn",
@@ -96,81 +520,664 @@ FFMPEG_OPTS = {
 # ✅ fallback keyword (if radio empty)
 DEFAULT_AUTOPLAY_QUERY = os.getenv("DEFAULT_AUTOPLAY_QUERY", "lofi hip hop")
 
-@dataclass
+# ✅ extraction cache (LRU, entries expire together with the googlevideo stream URL)
+EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "256"))
+EXTRACT_CACHE_TTL = int(os.getenv("EXTRACT_CACHE_TTL", "1800"))       # when the URL has no expire=
+STREAM_EXPIRY_MARGIN = int(os.getenv("STREAM_EXPIRY_MARGIN", "300"))  # refresh this early
+TRACK_CACHE_MAX_ROWS = int(os.getenv("TRACK_CACHE_MAX_ROWS", "5000"))   # persistent track_cache table
+
+@dataclass(slots=True)
 class Track:
     title: str
     webpage_url: str
-    stream_url: str
+    stream_url: str = ""  # empty until resolved right before playback (see resolve_stream)
+    video_id: str | None = None
+    duration: int | None = None
+    codec: str | None = None  # yt-dlp acodec of stream_url, e.g. "opus"
 
 class GuildMusicState:
+    __slots__ = (
+        "queue", "text_channel_id", "radio_pos", "current_track", "loop", "autoplay",
+        "now_playing_channel_id", "now_playing_msg_id", "prefetch_task", "prefetched",
+        "track_ended_at", "radio_batch", "refill_task", "last_active", "history",
+    )
+
     def __init__(self):
         self.queue: deque[Track] = deque()
         self.text_channel_id: int | None = None
         self.radio_pos: int = 0
-        self.is_playing_next: bool = False
         self.current_track: Track | None = None
         self.loop: bool = False
         self.autoplay: bool = True
-        self.now_playing_msg: discord.Message | None = None
+        # ids only: a cached discord.Message drags its embeds, author and components along
+        self.now_playing_channel_id: int | None = None
+        self.now_playing_msg_id: int | None = None
+        self.prefetch_task: asyncio.Task | None = None
+        self.prefetched: tuple[Track, discord.AudioSource] | None = None
+        self.track_ended_at: float | None = None
+        self.radio_batch: int = RADIO_BATCH
+        self.refill_task: asyncio.Task | None = None
+        self.last_active: float = time.monotonic()
+        # video ids, oldest first; allocated on the first play so idle guilds don't pay for it
+        self.history: deque[str] | None = None
+
+    def remember_played(self, video_id: str):
+        if self.history is None:
+            self.history = deque(maxlen=AUTOPLAY_HISTORY)
+        self.history.append(video_id)
 
 music_states: dict[int, GuildMusicState] = {}
 
 def get_state(guild_id: int) -> GuildMusicState:
-    if guild_id not in music_states:
-        music_states[guild_id] = GuildMusicState()
-    return music_states[guild_id]
+    state = music_states.get(guild_id)
+    if state is None:
+        # settings live in guild_configs, so an evicted state comes back with them
+        state = music_states[guild_id] = GuildMusicState()
+        cfg = guild_configs.get(guild_id)
+        if cfg:
+            state.autoplay = cfg.autoplay
+            state.radio_batch = cfg.radio_batch
+            state.radio_pos = cfg.radio_pos
+            state.loop = cfg.loop
+    state.last_active = time.monotonic()
+    return state
 
 # =========================
 # yt-dlp helpers
 # =========================
-async def ytdlp_extract(query_or_url: str) -> Track:
-    loop = asyncio.get_running_loop()
+YT_WATCH_RE = re.compile(r'https?://(?:www\.)?youtube\.com/watch\?.*?v=([\w-]+)')
+YT_PLAYLIST_RE = re.compile(r'(?:youtube\.com|youtu\.be)/\S*?[?&]list=([\w-]+)')
+YT_ID_RE = re.compile(r'(?:youtube\.com/(?:watch\?.*?v=|shorts/)|youtu\.be/)([\w-]{11})')
+EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+# one instance per (thread, kind): YoutubeDL is not thread-safe, but building one
+# re-initializes every extractor, re-reads cookies.txt and rebuilds the HTTP opener
+_ydl_local = threading.local()
+_ydl_opts_by_kind = {"full": YDL_OPTS, "flat": FLAT_YDL_OPTS, "playlist": PLAYLIST_YDL_OPTS}
+ydl_pool_stats = {"created": 0, "recycled": 0}
+
+def _close_ydl(ydl):
+    try:
+        ydl.close()
+    except Exception:
+        pass
+
+_YoutubeDL = None
+
+def ydl_class():
+    """yt_dlp.YoutubeDL, imported on first use (normally by the warm-up in the extract threads)."""
+    global _YoutubeDL
+    if _YoutubeDL is None:
+        from yt_dlp import YoutubeDL
+        _YoutubeDL = YoutubeDL
+    return _YoutubeDL
+
+def get_ydl(kind: str = "full") -> "yt_dlp.YoutubeDL":
+    """Long-lived YoutubeDL for the calling thread; only call from executor threads."""
+    pool = getattr(_ydl_local, "pool", None)
+    if pool is None:
+        pool = _ydl_local.pool = {}
+    now = time.monotonic()
+    entry = pool.get(kind)
+    if entry and (entry[2] >= YDL_RECYCLE_USES or now - entry[1] >= YDL_RECYCLE_SECONDS):
+        _close_ydl(entry[0])
+        ydl_pool_stats["recycled"] += 1
+        entry = None
+    if entry is None:
+        entry = [ydl_class()(_ydl_opts_by_kind[kind]), now, 0]
+        pool[kind] = entry
+        ydl_pool_stats["created"] += 1
+    entry[2] += 1
+    return entry[0]
+
+def warm_ydl():
+    # thread initializer: if it raised, the executor would be broken for good, and
+    # warming is only an optimisation (get_ydl builds lazily and reports errors per job)
+    try:
+        for kind in _ydl_opts_by_kind:
+            get_ydl(kind)
+    except Exception as e:
+        print(f"[ydl] warm-up fail: {e}")
+        return
+    mark_startup("ydl_warm")
 
+# =========================
+# Extraction scheduler
+# =========================
+class ExtractionCancelled(Exception):
+    """The guild ran /stop or /clear while its extraction was queued or running."""
+
+class ExtractScheduler:
+    """Runs blocking yt-dlp calls on its own small thread pool.
+
+    Jobs wait in per-guild queues; interactive jobs (/play, music channel) always go
+    before background ones (radio refill, autoplay), and guilds are served round-robin
+    so one guild pasting 30 songs cannot starve the others.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._pool: ThreadPoolExecutor | None = None
+        self._queues: tuple[dict[int, deque], dict[int, deque]] = ({}, {})  # (interactive, background)
+        self._order: tuple[deque[int], deque[int]] = (deque(), deque())
+        self._running: dict[asyncio.Future, int] = {}
+        self._followers: dict[asyncio.Future, int] = {}  # callers sharing another caller's job
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if self._pool is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="ytdlp", initializer=warm_ydl
+        )
+        # spawn every thread now so the YoutubeDL warm-up happens before the first request
+        for _ in range(self.workers):
+            self._pool.submit(lambda: None)
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, fn, guild_id: int = 0, interactive: bool = True, source: str = "play") -> asyncio.Future:
+        self.start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        t0 = loop.time()
+
+        def _observe(f: asyncio.Future):
+            # queue wait + yt-dlp time, i.e. what the caller actually waits for
+            if not f.cancelled() and f.exception() is None:
+                extract_latency.observe(loop.time() - t0, source)
+
+        fut.add_done_callback(_observe)
+        prio = 0 if interactive else 1
+        q = self._queues[prio].get(guild_id)
+        if q is None:
+            q = self._queues[prio][guild_id] = deque()
+            self._order[prio].append(guild_id)
+        q.append((fn, fut))
+        self._wakeup.set()
+        return fut
+
+    def follow(self, shared: asyncio.Future, guild_id: int = 0) -> asyncio.Future:
+        """Future mirroring an already submitted job; cancel_guild(guild_id) still cancels it.
+
+        Resolves to None when the shared job was cancelled by its own guild, so the
+        caller can submit again instead of failing for someone else's /stop.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._followers[fut] = guild_id
+        fut.add_done_callback(lambda f: self._followers.pop(f, None))
+
+        def _copy(src: asyncio.Future):
+            if fut.done():
+                return
+            if src.cancelled() or isinstance(src.exception(), ExtractionCancelled):
+                fut.set_result(None)
+            elif src.exception() is not None:
+                fut.set_exception(src.exception())
+            else:
+                fut.set_result(src.result())
+
+        shared.add_done_callback(_copy)
+        return fut
+
+    def pending(self) -> int:
+        return sum(len(q) for queues in self._queues for q in queues.values())
+
+    def cancel_guild(self, guild_id: int) -> int:
+        cancelled = 0
+        for prio in (0, 1):
+            q = self._queues[prio].pop(guild_id, None)
+            try:
+                self._order[prio].remove(guild_id)
+            except ValueError:
+                pass
+            for _, fut in q or ():
+                if not fut.done():
+                    fut.set_exception(ExtractionCancelled())
+                    cancelled += 1
+        # running jobs can't be interrupted; their result is just dropped
+        for fut, gid in [*self._running.items(), *self._followers.items()]:
+            if gid == guild_id and not fut.done():
+                fut.set_exception(ExtractionCancelled())
+                cancelled += 1
+        return cancelled
+
+    def _next_job(self):
+        for prio in (0, 1):
+            queues, order = self._queues[prio], self._order[prio]
+            while order:
+                gid = order.popleft()
+                q = queues.get(gid)
+                if not q:
+                    queues.pop(gid, None)
+                    continue
+                fn, fut = q.popleft()
+                if q:
+                    order.append(gid)  # more work -> back of the line
+                else:
+                    del queues[gid]
+                if fut.done():
+                    continue
+                return gid, fn, fut
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            gid, fn, fut = job
+            self._running[fut] = gid
+            try:
+                result = await loop.run_in_executor(self._pool, fn)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+            finally:
+                self._running.pop(fut, None)
+
+extract_scheduler = ExtractScheduler(EXTRACT_WORKERS)
+
+def youtube_video_id(query_or_url: str) -> str | None:
+    m = YT_ID_RE.search(query_or_url)
+    return m.group(1) if m else None
+
+def cache_key(query_or_url: str) -> str:
+    """Same video -> same key no matter how the URL was written; searches are case/space-insensitive."""
+    vid = youtube_video_id(query_or_url)
+    if vid:
+        return f"yt:{vid}"
+    return "q:" + " ".join(query_or_url.lower().split())
+
+def stream_url_expiry(url: str) -> float | None:
+    m = EXPIRE_RE.search(url or "")
+    return float(m.group(1)) if m else None
+
+def stream_url_stale(url: str, ahead: float = 0.0) -> bool:
+    """True if the URL will have expired (minus the safety margin) `ahead` seconds from now."""
+    expires_at = stream_url_expiry(url)
+    return expires_at is not None and expires_at - STREAM_EXPIRY_MARGIN < time.time() + ahead
+
+class ExtractCache:
+    """LRU of resolved tracks. Stale entries are kept so only the stream URL has to be re-resolved."""
+
+    def __init__(self, maxsize: int, ttl: int, margin: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.margin = margin
+        self._entries: OrderedDict[str, tuple[Track, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.coalesced = 0  # callers that joined an identical in-flight extraction
+        self._avg_extract = 0.0
+
+    def get(self, key: str, need_stream: bool = True) -> tuple[Track, bool] | None:
+        """Returns (track copy, fresh) or None. need_stream=False: the caller only wants metadata."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        track, expires_at = entry
+        fresh = not need_stream or (bool(track.stream_url) and time.time() < expires_at - self.margin)
+        if fresh:
+            self.hits += 1
+        else:
+            self.refreshes += 1
+        return replace(track), fresh
+
+    def put(self, key: str, track: Track):
+        expires_at = stream_url_expiry(track.stream_url) or (time.time() + self.ttl)
+        self._entries[key] = (track, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def record_extract(self, seconds: float):
+        # EWMA of a cold extraction, used to estimate the latency saved by hits
+        self._avg_extract = seconds if not self._avg_extract else 0.8 * self._avg_extract + 0.2 * seconds
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.refreshes
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "avg_extract_s": round(self._avg_extract, 3),
+            "saved_s": round((self.hits + self.coalesced) * self._avg_extract, 1),
+        }
+
+extract_cache = ExtractCache(EXTRACT_CACHE_SIZE, EXTRACT_CACHE_TTL, STREAM_EXPIRY_MARGIN)
+
+# ✅ single-flight: concurrent extractions of the same video/query share one yt-dlp call
+extract_inflight: dict[str, asyncio.Future] = {}
+
+async def single_flight(flight_key: str, fn, guild_id: int, interactive: bool, source: str):
+    """Submit `fn` unless an identical job is in flight. Returns (result, joined).
+
+    A joined caller gets None when the shared job was cancelled by the leader's guild,
+    so it can submit again instead of failing for someone else's /stop.
+    """
+    shared = extract_inflight.get(flight_key)
+    if shared is not None:
+        extract_cache.coalesced += 1
+        return await extract_scheduler.follow(shared, guild_id), True
+    fut = extract_scheduler.submit(fn, guild_id, interactive, source)
+    extract_inflight[flight_key] = fut
+    fut.add_done_callback(lambda f: extract_inflight.pop(flight_key, None))
+    # shield: if this caller's task is cancelled the followers still get the result
+    return await asyncio.shield(fut), False
+
+async def ytdlp_extract(query_or_url: str, guild_id: int = 0, interactive: bool = True, source: str = "play") -> Track:
+    requested = query_or_url
     # If URL contains playlist param, strip to single video id (v=)
-    import re
-    yt_match = re.match(r'https?://(?:www\.)?youtube\.com/watch\?.*?v=([\w-]+)', query_or_url)
+    yt_match = YT_WATCH_RE.match(query_or_url)
     if yt_match:
         query_or_url = f"https://www.youtube.com/watch?v={yt_match.group(1)}"
 
+    key = cache_key(query_or_url)
+    cached = extract_cache.get(key)
+    if cached:
+        track, fresh = cached
+        if fresh:
+            return track
+        # metadata is still good, only the stream URL expired -> skip the search step
+        query_or_url = track.webpage_url
+    else:
+        # survived a restart? then search -> video is a local lookup
+        row = await track_cache_lookup(key)
+        if row:
+            query_or_url = row["webpage_url"]
+
     def _extract():
-        with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
-            info = ydl.extract_info(query_or_url, download=False)
-            if "entries" in info and info["entries"]:
-                info = info["entries"][0]
-            return Track(
-                title=info.get("title", "Unknown"),
-                webpage_url=info.get("webpage_url", query_or_url),
-                stream_url=info["url"],
-            )
-
-    return await loop.run_in_executor(None, _extract)
-
-async def ytdlp_related(webpage_url: str) -> "Track | None":
-    """Autoplay: find a related YouTube track"""
-    loop = asyncio.get_running_loop()
+        info = get_ydl("full").extract_info(query_or_url, download=False)
+        if "entries" in info and info["entries"]:
+            info = info["entries"][0]
+        return Track(
+            title=info.get("title", "Unknown"),
+            webpage_url=info.get("webpage_url", query_or_url),
+            stream_url=info["url"],
+            video_id=info.get("id"),
+            duration=info.get("duration"),
+            codec=info.get("acodec"),
+        )
 
-    def _get_related():
-        opts = {
-            "format": "bestaudio/best",
-            "quiet": True,
-            "noplaylist": True,
-            "extract_flat": True,
-        }
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(webpage_url, download=False)
-            related = info.get("related_videos") or []
-            if related:
-                return related[0].get("id"), None
-            return None, info.get("title", "")
+    # keyed by what is actually extracted: a search that track_cache already mapped
+    # to its video joins a pasted link of the same video
+    t0 = time.perf_counter()
+    track, joined = await single_flight(cache_key(query_or_url), _extract, guild_id, interactive, source)
+    if joined:
+        if track is None:  # the leader's guild cancelled it, we still want the track
+            return await ytdlp_extract(requested, guild_id, interactive, source)
+        extract_cache.put(key, track)
+        return replace(track)
+    extract_cache.record_extract(time.perf_counter() - t0)
+
+    keys = [key]
+    if track.video_id and key != f"yt:{track.video_id}":
+        keys.append(f"yt:{track.video_id}")
+    for k in keys:
+        extract_cache.put(k, track)
+    try:
+        await track_cache_store(keys, track)
+    except Exception as e:
+        print(f"[track_cache] store fail: {e}")
+    return replace(track)
+
+async def ytdlp_flat_search(query: str, guild_id: int = 0, interactive: bool = False, source: str = "play") -> dict:
+    """Cheap search -> {id, title, url, duration} without resolving formats ({} if nothing found)."""
+    def _search():
+        info = get_ydl("flat").extract_info(f"ytsearch1:{query}", download=False)
+        entries = info.get("entries") or []
+        return entries[0] if entries else {}
+
+    # "flat:" keeps these dict results apart from ytdlp_extract's Track results
+    entry, joined = await single_flight(f"flat:{cache_key(query)}", _search, guild_id, interactive, source)
+    if joined and entry is None:
+        return await ytdlp_flat_search(query, guild_id, interactive, source)
+    return entry
+
+def track_from_flat(entry: dict, fallback_title: str = "Unknown") -> Track:
+    vid = entry["id"]
+    return Track(
+        title=entry.get("title") or fallback_title,
+        webpage_url=f"https://www.youtube.com/watch?v={vid}",
+        video_id=vid,
+        duration=entry.get("duration"),
+    )
 
+async def ytdlp_lookup(query_or_url: str, guild_id: int = 0, interactive: bool = True, source: str = "play") -> Track:
+    """Enqueue-time lookup: title + video page only. The stream URL is fetched by resolve_stream."""
+    key = cache_key(query_or_url)
+    if key.startswith("yt:") or query_or_url.startswith(("http://", "https://")):
+        # direct links need the page for a title anyway; this also primes the stream cache
+        return await ytdlp_extract(query_or_url, guild_id, interactive, source)
+
+    # memory first: metadata is all we need here, so a missing / expired stream URL is still a hit
+    cached = extract_cache.get(key, need_stream=False)
+    if cached:
+        return cached[0]
+    row = await track_cache_lookup(key)
+    if row:
+        track = Track(
+            title=row["title"],
+            webpage_url=row["webpage_url"],
+            video_id=row["video_id"],
+            duration=row["duration"],
+        )
+        extract_cache.put(key, track)
+        return replace(track)
+
+    entry = await ytdlp_flat_search(query_or_url, guild_id, interactive, source)
+    if not entry or not entry.get("id"):
+        raise LookupError(f"no results for {query_or_url!r}")
+    track = track_from_flat(entry, query_or_url)
+    extract_cache.put(key, replace(track))
+    try:
+        await track_cache_store([key, f"yt:{track.video_id}"], track)
+    except Exception as e:
+        print(f"[track_cache] store fail: {e}")
+    return track
+
+async def resolve_stream(track: Track, guild_id: int = 0, interactive: bool = True, ahead: float = 0.0,
+                         source: str = "resolve") -> Track:
+    """Just-in-time stream URL: fetch it if missing or expiring within `ahead` seconds."""
+    if track.stream_url and not stream_url_stale(track.stream_url, ahead):
+        return track
+    fresh = await ytdlp_extract(track.webpage_url, guild_id, interactive, source)
+    track.stream_url = fresh.stream_url
+    track.video_id = track.video_id or fresh.video_id
+    track.duration = track.duration or fresh.duration
+    track.codec = fresh.codec
+    return track
+
+def flat_entries(ydl, url: str):
+    """Lazy entries of a playlist / mix URL (process=False: nothing is resolved). Thread-side only."""
+    info = ydl.extract_info(url, download=False, process=False)
+    while info.get("_type") in ("url", "url_transparent"):  # watch?v=..&list=.. -> the list itself
+        info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+    return info.get("entries") or ()
+
+async def ytdlp_playlist(url: str, guild_id: int, limit: int):
+    """Yields pages of unresolved tracks while yt-dlp is still paging through the playlist.
+
+    One scheduler job walks the lazy entries generator (so a single YoutubeDL is used
+    from a single thread) and hands every PLAYLIST_PAGE entries back to the loop.
+    """
+    loop = asyncio.get_running_loop()
+    pages: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def _stream():
+        page, total = [], 0
+        for entry in flat_entries(get_ydl("playlist"), url):
+            if stop.is_set() or total >= limit:
+                break
+            if not entry or not entry.get("id"):
+                continue
+            page.append(track_from_flat(entry))
+            total += 1
+            if len(page) >= PLAYLIST_PAGE:
+                loop.call_soon_threadsafe(pages.put_nowait, page)
+                page = []
+        if page:
+            loop.call_soon_threadsafe(pages.put_nowait, page)
+        return total
+
+    def _done(f: asyncio.Future):
+        stop.set()  # /stop or /clear: the thread quits at the next entry
+        pages.put_nowait(None)
+
+    fut = extract_scheduler.submit(_stream, guild_id, True, "playlist")
+    fut.add_done_callback(_done)
+    try:
+        while (page := await pages.get()) is not None:
+            if fut.done() and fut.exception() is not None:
+                break
+            yield page
+        await fut  # re-raises ExtractionCancelled / extraction errors
+    finally:
+        stop.set()
+
+async def queue_playlist(guild: discord.Guild, url: str) -> tuple[int, int]:
+    """Queues a playlist / mix as lazy tracks; playback starts after the first page.
+
+    Returns (added, limit): limit is the cap that applied, PLAYLIST_MAX or the room left in the queue.
+    """
+    state = get_state(guild.id)
+    limit = min(PLAYLIST_MAX, MAX_QUEUE - len(state.queue))
+    added = 0
+    if limit <= 0:
+        return added, limit
+    try:
+        async for page in ytdlp_playlist(url, guild.id, limit):
+            state.queue.extend(page)
+            if not added:
+                get_player(guild.id).post("play")  # no-op when something is already playing
+            added += len(page)
+    except ExtractionCancelled:
+        raise
+    except Exception as e:
+        if not added:
+            raise
+        print(f"[playlist] stopped after {added} tracks: {e}")
+    return added, limit
+
+def playlist_summary(added: int, limit: int) -> str:
+    if limit <= 0:
+        return f"📛 播放清單已滿（上限 {MAX_QUEUE} 首）。"
+    if not added:
+        return "❌ 無法讀取該播放清單。"
+    capped = ""
+    if added >= limit:
+        capped = f"（上限 {PLAYLIST_MAX} 首）" if limit == PLAYLIST_MAX else f"（播放清單已滿，上限 {MAX_QUEUE} 首）"
+    return f"📃 已從播放清單加入 **{added}** 首{capped}"
+
+class RelatedCache:
+    """video id -> related candidates ({id, title, duration}); LRU with a TTL, one fetch per id at a time."""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[list[dict], float]] = OrderedDict()
+        self._fetching: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, video_id: str, guild_id: int = 0, interactive: bool = False) -> list[dict]:
+        entry = self._entries.get(video_id)
+        if entry and entry[1] > time.time():
+            self._entries.move_to_end(video_id)
+            self.hits += 1
+            return entry[0]
+        task = self._fetching.get(video_id)
+        if task is None:
+            self.misses += 1
+            task = self._fetching[video_id] = asyncio.create_task(self._fetch(video_id, guild_id, interactive))
+            task.add_done_callback(lambda _: self._fetching.pop(video_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, video_id: str, guild_id: int, interactive: bool) -> list[dict]:
+        watch_url = f"https://www.youtube.com/watch?v={video_id}"
+
+        def _get():
+            entries = []
+            try:
+                # the video's YouTube mix: ~50 flat entries from one request, no format resolving
+                for entry in flat_entries(get_ydl("playlist"), f"{watch_url}&list=RD{video_id}"):
+                    entries.append(entry)
+                    if len(entries) >= RELATED_CANDIDATES:
+                        break
+            except Exception as e:
+                print(f"[related] mix fail for {video_id}: {e}")
+            if not entries:
+                entries = get_ydl("flat").extract_info(watch_url, download=False).get("related_videos") or []
+            return [
+                {"id": e["id"], "title": e.get("title"), "duration": e.get("duration")}
+                for e in entries if e and e.get("id")
+            ]
+
+        candidates = await extract_scheduler.submit(_get, guild_id, interactive, "related")
+        self._entries[video_id] = (candidates, time.time() + self.ttl)
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return candidates
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+related_cache = RelatedCache(RELATED_CACHE_SIZE, RELATED_CACHE_TTL)
+_warm_tasks: set[asyncio.Task] = set()  # the loop only keeps weak references to tasks
+
+async def warm_related(video_id: str, guild_id: int):
     try:
-        vid_id, fallback_title = await loop.run_in_executor(None, _get_related)
-        if vid_id:
-            return await ytdlp_extract(f"https://www.youtube.com/watch?v={vid_id}")
-        elif fallback_title:
-            return await ytdlp_extract(fallback_title)
+        await related_cache.get(video_id, guild_id)
     except Exception:
         pass
+
+async def autoplay_pick(guild_id: int, seed: Track, interactive: bool = False) -> Track | None:
+    """Autoplay: first related candidate that was not played recently and is not queued.
+
+    Falls back to the related lists of the previous tracks when everything around
+    `seed` was heard already, so two songs can no longer ping-pong forever.
+    """
+    state = get_state(guild_id)
+    history = state.history or ()
+    avoid = set(history)
+    avoid.update(t.video_id for t in state.queue)
+    seeds = [seed.video_id] + [vid for vid in reversed(history) if vid != seed.video_id][:2]
+    for vid in seeds:
+        if not vid:
+            continue
+        try:
+            candidates = await related_cache.get(vid, guild_id, interactive)
+        except Exception as e:
+            print(f"[autoplay] related fail for {vid}: {e}")
+            continue
+        for entry in candidates:
+            if entry["id"] not in avoid:
+                track = track_from_flat(entry)
+                # the pick after this one will be a cache hit
+                task = asyncio.create_task(warm_related(track.video_id, guild_id))
+                _warm_tasks.add(task)
+                task.add_done_callback(_warm_tasks.discard)
+                return track
     return None
 
 # =========================
@@ -185,8 +1192,19 @@ def pick_default_text_channel(guild: discord.Guild) -> int | None:
             return ch.id
     return None
 
+# one connect at a time per guild: discord.py registers the voice client before connect()
+# finishes, so a second caller would see it "not connected" and force-disconnect it
+_connect_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
 async def safe_connect(channel: discord.VoiceChannel, guild: discord.Guild):
     """Safe connect that clears stale sessions (fixes 4006 errors)"""
+    lock = _connect_locks.get(guild.id)
+    if lock is None:
+        lock = _connect_locks[guild.id] = asyncio.Lock()
+    async with lock:
+        return await _safe_connect(channel, guild)
+
+async def _safe_connect(channel: discord.VoiceChannel, guild: discord.Guild):
     vc = guild.voice_client
     if vc and vc.is_connected():
         if vc.channel and vc.channel.id == channel.id:
@@ -230,126 +1248,312 @@ class NowPlayingView(discord.ui.View):
     def _vc(self):
         return self.guild.voice_client
 
+    def sync(self, state: "GuildMusicState"):
+        """Button look follows the real state (a reused message outlives pause / loop changes)."""
+        vc = self._vc()
+        self.pause_btn.emoji = "▶️" if vc and vc.is_paused() else "⏸️"
+        self.loop_btn.style = discord.ButtonStyle.success if state.loop else discord.ButtonStyle.secondary
+        self.autoplay_btn.style = discord.ButtonStyle.success if state.autoplay else discord.ButtonStyle.secondary
+
+    async def _refresh(self, interaction: discord.Interaction):
+        # the interaction callback edits the message without touching the channel's rate limit
+        state = get_state(self.guild.id)
+        self.sync(state)
+        if state.current_track:
+            await interaction.response.edit_message(embed=now_playing_embed(state, state.current_track), view=self)
+        else:
+            await interaction.response.edit_message(view=self)
+
     @discord.ui.button(emoji="⏸️", style=discord.ButtonStyle.primary, custom_id="np_pause")
     async def pause_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
         vc = self._vc()
         if vc and vc.is_playing():
             vc.pause()
-            button.emoji = "▶️"
-            await interaction.message.edit(view=self)
         elif vc and vc.is_paused():
             vc.resume()
-            button.emoji = "⏸️"
-            await interaction.message.edit(view=self)
+        await self._refresh(interaction)
 
     @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary, custom_id="np_skip")
     async def skip_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer()
         vc = self._vc()
-        state = get_state(self.guild.id)
         if vc and (vc.is_playing() or vc.is_paused()):
-            state.is_playing_next = False
-            vc.stop()
+            get_player(self.guild.id).post("skip")
         await interaction.followup.send("⏭️ 已跳過。", ephemeral=True)
 
     @discord.ui.button(emoji="🔁", style=discord.ButtonStyle.secondary, custom_id="np_loop")
     async def loop_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
         state = get_state(self.guild.id)
         state.loop = not state.loop
-        button.style = discord.ButtonStyle.success if state.loop else discord.ButtonStyle.secondary
-        await interaction.message.edit(view=self)
+        await self._refresh(interaction)
         status = "開啟 🔁" if state.loop else "關閉"
         await interaction.followup.send(f"單曲循環 {status}", ephemeral=True)
 
     @discord.ui.button(emoji="🎲", style=discord.ButtonStyle.secondary, custom_id="np_autoplay")
     async def autoplay_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
         state = get_state(self.guild.id)
         state.autoplay = not state.autoplay
-        button.style = discord.ButtonStyle.success if state.autoplay else discord.ButtonStyle.secondary
-        await interaction.message.edit(view=self)
+        await self._refresh(interaction)
+        await save_guild_settings(self.guild.id, autoplay=state.autoplay)
         status = "開啟 ✅" if state.autoplay else "關閉"
         await interaction.followup.send(f"Autoplay {status}", ephemeral=True)
 
     @discord.ui.button(emoji="⏹️", style=discord.ButtonStyle.danger, custom_id="np_stop")
     async def stop_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer()
-        state = get_state(self.guild.id)
-        state.queue.clear()
-        state.is_playing_next = False
-        state.current_track = None
-        state.loop = False
-        vc = self._vc()
-        if vc and vc.is_connected():
-            vc.stop()
-            await vc.disconnect()
-        await interaction.message.edit(view=None)
+        await interaction.response.edit_message(view=None)
+        get_state(self.guild.id).queue.clear()
+        extract_scheduler.cancel_guild(self.guild.id)
+        get_player(self.guild.id).post("stop", True)
+        await get_ui(self.guild.id).close(self.guild, edit=False)
         await interaction.followup.send("⏹️ 已停止並退出語音。", ephemeral=True)
 
 # =========================
 # DB helpers
 # =========================
-async def get_music_channel(guild_id: int) -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT channel_id FROM music_channels WHERE guild_id = ?", (guild_id,))
-        row = await cur.fetchone()
-    return row[0] if row else None
+@dataclass
+class GuildConfig:
+    music_channel_id: int | None = None
+    always_on: bool = False
+    autoplay: bool = True
+    radio_batch: int = RADIO_BATCH
+    radio_pos: int = 0  # saved when the guild's state is evicted
+    loop: bool = False
+
+# ✅ write-through cache: loaded once at startup, so on_message never touches SQLite
+guild_configs: dict[int, GuildConfig] = {}
+
+async def load_guild_configs():
+    guild_configs.clear()
+    for gid, channel_id in await database.fetchall("SELECT guild_id, channel_id FROM music_channels"):
+        if owns_guild(gid):
+            guild_configs.setdefault(gid, GuildConfig()).music_channel_id = channel_id
+    for gid, on, auto, batch, pos, loop in await database.fetchall(
+        "SELECT guild_id, always_on, autoplay, radio_batch, radio_pos, loop FROM guild_settings"
+    ):
+        if not owns_guild(gid):
+            continue  # another cluster serves it (and is the only writer of its rows)
+        cfg = guild_configs.setdefault(gid, GuildConfig())
+        cfg.always_on = bool(on)
+        cfg.autoplay = bool(auto)
+        cfg.radio_batch = batch or RADIO_BATCH
+        cfg.radio_pos = pos
+        cfg.loop = bool(loop)
+    always_on_guilds.clear()
+    always_on_guilds.update(gid for gid, cfg in guild_configs.items() if cfg.always_on)
+    print(f"[config] loaded {len(guild_configs)} guild configs")
+
+def get_music_channel(guild_id: int) -> int | None:
+    cfg = guild_configs.get(guild_id)
+    return cfg.music_channel_id if cfg else None
 
 async def set_music_channel(guild_id: int, channel_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO music_channels (guild_id, channel_id) VALUES (?, ?)",
-            (guild_id, channel_id)
+    await database.execute(
+        "INSERT OR REPLACE INTO music_channels (guild_id, channel_id) VALUES (?, ?)",
+        (guild_id, channel_id)
+    )
+    guild_configs.setdefault(guild_id, GuildConfig()).music_channel_id = channel_id
+
+GUILD_SETTINGS_UPSERT = (
+    "INSERT OR REPLACE INTO guild_settings (guild_id, always_on, autoplay, radio_batch, radio_pos, loop) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+def guild_settings_row(guild_id: int, cfg: GuildConfig) -> tuple:
+    return (guild_id, int(cfg.always_on), int(cfg.autoplay), cfg.radio_batch, cfg.radio_pos, int(cfg.loop))
+
+async def save_guild_settings(guild_id: int, **changes):
+    """Update always_on / autoplay / radio_batch in the cache and in guild_settings."""
+    cfg = guild_configs.setdefault(guild_id, GuildConfig())
+    for name, value in changes.items():
+        setattr(cfg, name, value)
+    if cfg.always_on:
+        always_on_guilds.add(guild_id)
+    else:
+        always_on_guilds.discard(guild_id)
+    await database.execute(GUILD_SETTINGS_UPSERT, guild_settings_row(guild_id, cfg))
+
+# last_used bumps of hits are kept here and written in batches (with the next store,
+# or once this many are pending), so lookups never wait for the write lock
+TRACK_CACHE_TOUCH_BATCH = 100
+_track_cache_touched: dict[str, float] = {}
+
+async def _flush_track_cache_touches(db):
+    rows = [(used, key) for key, used in _track_cache_touched.items()]
+    _track_cache_touched.clear()
+    if rows:
+        await db.executemany("UPDATE track_cache SET last_used = ? WHERE key = ?", rows)
+
+async def track_cache_lookup(key: str) -> dict | None:
+    row = await database.fetchone(
+        "SELECT video_id, title, webpage_url, duration FROM track_cache WHERE key = ?", (key,)
+    )
+    if row:
+        _track_cache_touched[key] = time.time()
+        if len(_track_cache_touched) >= TRACK_CACHE_TOUCH_BATCH:
+            async with database.transaction() as db:
+                await _flush_track_cache_touches(db)
+    return dict(row) if row else None
+
+_track_cache_writes = 0
+
+async def track_cache_store(keys: list[str], track: Track):
+    global _track_cache_writes
+    now = time.time()
+    async with database.transaction() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO track_cache (key, video_id, title, webpage_url, duration, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(k, track.video_id, track.title, track.webpage_url, track.duration, now) for k in keys],
         )
-        await db.commit()
+        await _flush_track_cache_touches(db)
+        _track_cache_writes += len(keys)
+        # size-based eviction, checked every ~100 writes
+        if _track_cache_writes >= 100:
+            _track_cache_writes = 0
+            await db.execute("""
+                DELETE FROM track_cache WHERE key IN (
+                    SELECT key FROM track_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (TRACK_CACHE_MAX_ROWS,))
+
+async def warm_track_cache_from_radio():
+    """Resolve every radio query that is not in track_cache yet (cheap flat search, one at a time)."""
+    rows = await database.fetchall("SELECT guild_id, query FROM radio")
+    queries = list(dict.fromkeys(query for gid, query in rows if owns_guild(gid)))
+    known = {r[0] for r in await database.fetchall("SELECT key FROM track_cache WHERE key LIKE 'q:%'")}
+
+    warmed = 0
+    for query in queries:
+        key = cache_key(query)
+        if key.startswith("yt:") or key in known or query.startswith(("http://", "https://")):
+            continue  # URLs already point at the video page
+        try:
+            await ytdlp_lookup(query, interactive=False, source="warm")  # flat search, stored in track_cache
+        except Exception as e:
+            print(f"[track_cache] warm fail for {query!r}: {e}")
+            continue
+        warmed += 1
+    print(f"[track_cache] warmed {warmed} radio entries")
 
-async def load_radio_list(guild_id: int) -> list[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+# ✅ per-guild radio lists, read from SQLite once and then kept in sync by the radio_* helpers
+radio_lists: dict[int, tuple[str, ...]] = {}
+
+async def load_radio_list(guild_id: int) -> tuple[str, ...]:
+    radio = radio_lists.get(guild_id)
+    if radio is None:
+        rows = await database.fetchall(
             "SELECT query FROM radio WHERE guild_id = ? ORDER BY idx ASC",
             (guild_id,)
         )
-        rows = await cur.fetchall()
-    return [r[0] for r in rows]
+        radio = radio_lists[guild_id] = tuple(r[0] for r in rows)
+    return radio
+
+async def _radio_rows(db, guild_id: int) -> list[str]:
+    """Current list as seen inside an open transaction (the cache may be behind)."""
+    cur = await db.execute("SELECT query FROM radio WHERE guild_id = ? ORDER BY idx ASC", (guild_id,))
+    return [r[0] for r in await cur.fetchall()]
+
+async def _radio_rewrite(db, guild_id: int, queries) -> None:
+    await db.execute("DELETE FROM radio WHERE guild_id = ?", (guild_id,))
+    await db.executemany(
+        "INSERT INTO radio (guild_id, idx, query) VALUES (?, ?, ?)",
+        [(guild_id, i, q) for i, q in enumerate(queries)],
+    )
 
-async def radio_fill_queue(guild: discord.Guild, count: int = 3) -> bool:
+async def radio_add_many(guild_id: int, queries: list[str]) -> tuple[str, ...]:
+    """Append in one transaction; the cached list is rebuilt from the rows it committed against."""
+    async with database.transaction() as db:
+        current = await _radio_rows(db, guild_id)
+        cur = await db.execute("SELECT COALESCE(MAX(idx), -1) FROM radio WHERE guild_id = ?", (guild_id,))
+        (mx,) = await cur.fetchone()
+        start = int(mx) + 1
+        await db.executemany(
+            "INSERT INTO radio (guild_id, idx, query) VALUES (?, ?, ?)",
+            [(guild_id, start + i, q) for i, q in enumerate(queries)],
+        )
+    radio = radio_lists[guild_id] = tuple(current) + tuple(queries)
+    return radio
+
+async def radio_replace(guild_id: int, queries: list[str] | tuple[str, ...]) -> tuple[str, ...]:
+    """Rewrite the whole list (renumbering idx) in one transaction."""
+    async with database.transaction() as db:
+        await _radio_rewrite(db, guild_id, queries)
+    radio = radio_lists[guild_id] = tuple(queries)
+    return radio
+
+async def radio_remove_at(guild_id: int, index: int) -> str | None:
+    """Read-modify-write under the write lock; None if index is no longer valid."""
+    async with database.transaction() as db:
+        radio = await _radio_rows(db, guild_id)
+        if not 0 <= index < len(radio):
+            radio_lists[guild_id] = tuple(radio)
+            return None
+        removed = radio.pop(index)
+        await _radio_rewrite(db, guild_id, radio)
+    radio_lists[guild_id] = tuple(radio)
+    return removed
+
+async def radio_move(guild_id: int, src: int, dst: int) -> str | None:
+    async with database.transaction() as db:
+        radio = await _radio_rows(db, guild_id)
+        if not (0 <= src < len(radio) and 0 <= dst < len(radio)):
+            radio_lists[guild_id] = tuple(radio)
+            return None
+        item = radio.pop(src)
+        radio.insert(dst, item)
+        await _radio_rewrite(db, guild_id, radio)
+    radio_lists[guild_id] = tuple(radio)
+    return item
+
+async def radio_fill_queue(guild: discord.Guild, count: int | None = None, interactive: bool = False) -> bool:
     state = get_state(guild.id)
     radio = await load_radio_list(guild.id)
     if not radio:
         return False
-    added = 0
-    for _ in range(count):
-        q = radio[state.radio_pos % len(radio)]
+
+    # claim positions up front so results are queued in radio order
+    queries = []
+    for _ in range(count or state.radio_batch):
+        queries.append(radio[state.radio_pos % len(radio)])
         state.radio_pos += 1
-        try:
-            track = await ytdlp_extract(q)
-            state.queue.append(track)
-            added += 1
-        except Exception as e:
-            print(f"[radio_fill_queue] extract fail: {e}")
+
+    sem = asyncio.Semaphore(RADIO_FILL_CONCURRENCY)
+
+    async def _resolve(q: str) -> Track:
+        async with sem:
+            return await ytdlp_lookup(q, guild.id, interactive=interactive, source="radio")
+
+    results = await asyncio.gather(*(_resolve(q) for q in queries), return_exceptions=True)
+    added = 0
+    for q, res in zip(queries, results):
+        if isinstance(res, BaseException):
+            print(f"[radio_fill_queue] extract fail for {q!r}: {res}")
             continue
+        state.queue.append(res)
+        added += 1
     return added > 0
 
-# =========================
-# Core playback
-# =========================
-async def send_now_playing(guild: discord.Guild, track: Track):
+def maybe_refill(guild: discord.Guild):
+    """Start a background radio refill once the queue drops below the low-water mark."""
     state = get_state(guild.id)
-    if not state.text_channel_id:
+    if len(state.queue) >= RADIO_LOW_WATER or state.loop:
         return
-    ch = guild.get_channel(state.text_channel_id)
-    if not isinstance(ch, discord.TextChannel):
+    if state.refill_task and not state.refill_task.done():
         return
+    state.refill_task = asyncio.create_task(radio_fill_queue(guild))
 
-    if state.now_playing_msg:
-        try:
-            await state.now_playing_msg.delete()
-        except Exception:
-            pass
-        state.now_playing_msg = None
+# =========================
+# Core playback
+# =========================
+def now_playing_message(guild: discord.Guild, state: GuildMusicState) -> discord.PartialMessage | None:
+    if not state.now_playing_msg_id:
+        return None
+    ch = guild.get_channel(state.now_playing_channel_id)
+    if not isinstance(ch, discord.TextChannel):
+        return None
+    return ch.get_partial_message(state.now_playing_msg_id)
 
+def now_playing_embed(state: GuildMusicState, track: Track) -> discord.Embed:
     loop_status = "🔁 ON" if state.loop else "OFF"
     auto_status = "✅ ON" if state.autoplay else "OFF"
 
@@ -360,84 +1564,866 @@ async def send_now_playing(guild: discord.Guild, track: Track):
     )
     embed.add_field(name="🔗 Link", value=f"<{track.webpage_url}>", inline=False)
     embed.set_footer(text=f"Loop: {loop_status}  |  Autoplay: {auto_status}  |  ⏸️ ⏭️ 🔁 🎲 ⏹️")
+    return embed
+
+# =========================
+# UI updates (now playing / queue notices)
+# =========================
+UI_MIN_INTERVAL = float(os.getenv("UI_MIN_INTERVAL", "1.5"))   # seconds between now-playing writes per guild
+UI_NOTICE_WINDOW = float(os.getenv("UI_NOTICE_WINDOW", "1.5")) # queue notices within this window -> one message
+
+ui_stats = {"edits": 0, "sends": 0, "superseded": 0, "notices": 0, "notices_merged": 0}
+
+class GuildUI:
+    """Outbound message scheduler of one guild.
+
+    The now-playing message is edited in place, at most one write is in flight and
+    at most one every UI_MIN_INTERVAL; the embed is rendered when the write happens,
+    so a burst of track changes / toggles collapses into one edit of the latest state.
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.view: NowPlayingView | None = None
+        self._dirty = False
+        self._task: asyncio.Task | None = None
+        self._last_write = 0.0
+        self._notices: list[str] = []
+        self._notice_channel: discord.abc.Messageable | None = None
+        self._notice_task: asyncio.Task | None = None
+
+    def now_playing(self):
+        if self._dirty:
+            ui_stats["superseded"] += 1
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._dirty:
+            wait = self._last_write + UI_MIN_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._dirty = False
+            guild = bot.get_guild(self.guild_id)
+            if guild is None:
+                return
+            try:
+                await self._write(guild)
+            except Exception as e:
+                print(f"[ui {self.guild_id}] now playing update fail: {e}")
+            self._last_write = time.monotonic()
+
+    async def _write(self, guild: discord.Guild):
+        state = get_state(guild.id)
+        track = state.current_track
+        if track is None or not state.text_channel_id:
+            return
+        ch = guild.get_channel(state.text_channel_id)
+        if not isinstance(ch, discord.TextChannel):
+            return
+        embed = now_playing_embed(state, track)
+
+        msg = now_playing_message(guild, state)
+        if msg and state.now_playing_channel_id == ch.id and self.view:
+            self.view.sync(state)
+            try:
+                await msg.edit(embed=embed, view=self.view)
+                ui_stats["edits"] += 1
+                return
+            except discord.NotFound:
+                pass  # deleted by someone: send a new one
+        elif msg:
+            try:
+                await msg.delete()  # the music moved to another channel
+            except Exception:
+                pass
+
+        if self.view:
+            self.view.stop()
+        self.view = NowPlayingView(guild)
+        self.view.sync(state)
+        new_msg = await ch.send(embed=embed, view=self.view)
+        ui_stats["sends"] += 1
+        state.now_playing_channel_id = ch.id
+        state.now_playing_msg_id = new_msg.id
+
+    def queued(self, channel: discord.abc.Messageable, title: str):
+        """Queue-add notice; everything queued within UI_NOTICE_WINDOW goes out as one message."""
+        self._notices.append(title)
+        self._notice_channel = channel
+        if self._notice_task is None or self._notice_task.done():
+            self._notice_task = asyncio.create_task(self._send_notices())
+
+    async def _send_notices(self):
+        await asyncio.sleep(UI_NOTICE_WINDOW)
+        titles, self._notices = self._notices, []
+        if not titles:
+            return
+        ui_stats["notices"] += 1
+        ui_stats["notices_merged"] += len(titles) - 1
+        if len(titles) == 1:
+            text = f"➕ 已加入播放清單：**{titles[0]}**"
+        else:
+            shown = "、".join(f"**{t}**" for t in titles[:5])
+            text = f"➕ 已加入 {len(titles)} 首：{shown}" + (" 等" if len(titles) > 5 else "")
+        try:
+            await self._notice_channel.send(text, delete_after=8)
+        except Exception:
+            pass
+
+    async def close(self, guild: discord.Guild, edit: bool = True):
+        """Playback stopped: drop pending updates and detach the buttons."""
+        self._dirty = False
+        if self._task and not self._task.done():
+            self._task.cancel()
+        state = get_state(guild.id)
+        msg = now_playing_message(guild, state)
+        if msg and edit:
+            try:
+                await msg.edit(view=None)
+            except Exception:
+                pass
+        state.now_playing_msg_id = None
+        if self.view:
+            self.view.stop()
+            self.view = None
+
+guild_uis: dict[int, GuildUI] = {}
+
+def get_ui(guild_id: int) -> GuildUI:
+    if guild_id not in guild_uis:
+        guild_uis[guild_id] = GuildUI(guild_id)
+    return guild_uis[guild_id]
+
+# =========================
+# Audio cache (repeat plays from local disk)
+# =========================
+class AudioCache:
+    """Copies played tracks to AUDIO_CACHE_DIR and serves repeats from disk.
+
+    The index lives in the audio_cache table so it survives restarts; total size is
+    kept under AUDIO_CACHE_MAX_BYTES by evicting the least recently played files.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_duration: int):
+        self.directory = directory
+        self.enabled = bool(directory)
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self._index: dict[str, list] = {}  # video_id -> [size, last_used, codec]
+        self._downloading: set[str] = set()
+        self._touched: set[str] = set()  # hits whose last_used is not in the table yet
+        self._tasks: set[asyncio.Task] = set()
+        self._flush_pending = False
+        self._download_sem = asyncio.Semaphore(1)  # one background download at a time
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, video_id: str) -> str:
+        return os.path.join(self.directory, f"{video_id}.audio")
+
+    async def load(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        stale = time.time() - 2 * self.max_duration  # newer .part files may be another cluster's download
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part") and os.path.getmtime(path) < stale:
+                os.remove(path)
+        missing = []
+        rows = await database.fetchall("SELECT video_id, size, last_used, codec FROM audio_cache")
+        for vid, size, last_used, codec in rows:
+            if os.path.exists(self._path(vid)):
+                self._index[vid] = [size, last_used, codec]
+            else:
+                missing.append((vid,))
+        if missing:
+            await database.executemany("DELETE FROM audio_cache WHERE video_id = ?", missing)
+        self.total_bytes = sum(entry[0] for entry in self._index.values())
+        print(f"[audio_cache] {len(self._index)} files, {self.total_bytes / 1e6:.1f} MB")
+
+    def has(self, video_id: str | None) -> bool:
+        return self.enabled and video_id in self._index
+
+    def lookup(self, track: Track) -> str | None:
+        if not self.enabled or not track.video_id:
+            return None
+        entry = self._index.get(track.video_id)
+        if entry is not None and not os.path.exists(self._path(track.video_id)):
+            # evicted by another cluster process sharing the directory
+            self.total_bytes -= entry[0]
+            del self._index[track.video_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[1] = time.time()
+        track.codec = entry[2]  # the file is a byte copy of the stream
+        self._touched.add(track.video_id)
+        if len(self._touched) >= AUDIO_CACHE_TOUCH_BATCH and not self._flush_pending:
+            self._flush_pending = True
+            self._spawn(self._flush_touches())
+        return self._path(track.video_id)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write_touches(self, db):
+        self._flush_pending = False
+        rows = [(self._index[vid][1], vid) for vid in self._touched if vid in self._index]
+        self._touched.clear()
+        if rows:
+            await db.executemany("UPDATE audio_cache SET last_used = ? WHERE video_id = ?", rows)
+
+    async def _flush_touches(self):
+        if self._touched:
+            async with database.transaction() as db:
+                await self._write_touches(db)
+
+    def maybe_store(self, track: Track):
+        if not self.enabled or not track.video_id or not track.stream_url:
+            return
+        if not track.duration or track.duration > self.max_duration:
+            return
+        if track.video_id in self._index or track.video_id in self._downloading:
+            return
+        self._downloading.add(track.video_id)
+        self._spawn(self._download(track.video_id, track.stream_url, track.codec))
+
+    async def _download(self, video_id: str, url: str, codec: str | None):
+        path = self._path(video_id)
+        tmp = f"{path}.{os.getpid()}.part"
+        try:
+            async with self._download_sem:
+                size = 0
+                timeout = aiohttp.ClientTimeout(total=self.max_duration)
+                async with aiohttp.ClientSession(timeout=timeout) as session, session.get(url) as resp:
+                    resp.raise_for_status()
+                    with open(tmp, "wb") as f:
+                        async for chunk in resp.content.iter_chunked(64 * 1024):
+                            f.write(chunk)
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise ValueError("larger than the whole cache budget")
+                os.replace(tmp, path)
+            now = time.time()
+            self._index[video_id] = [size, now, codec]
+            self.total_bytes += size
+            async with database.transaction() as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO audio_cache (video_id, size, last_used, codec) VALUES (?, ?, ?, ?)",
+                    (video_id, size, now, codec)
+                )
+                await self._write_touches(db)  # pending hits ride along with the insert
+            await self._evict()
+        except Exception as e:
+            print(f"[audio_cache] download fail for {video_id}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        finally:
+            self._downloading.discard(video_id)
+
+    async def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        await self._flush_touches()  # eviction orders by the table's last_used
+        # the table is shared by every cluster process, so budget against it, not self._index
+        rows = await database.fetchall("SELECT video_id, size FROM audio_cache ORDER BY last_used")
+        self.total_bytes = sum(size for _, size in rows)
+        victims = []
+        for vid, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(vid))
+            except OSError:
+                pass
+            self._index.pop(vid, None)
+            self.total_bytes -= size
+            self.evictions += 1
+            victims.append((vid,))
+        await database.executemany("DELETE FROM audio_cache WHERE video_id = ?", victims)
+
+    async def close(self):
+        """Shutdown: abandon downloads (stale .part files are removed by load) and write pending hits."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._flush_touches()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "files": len(self._index),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MAX_DURATION)
+
+playback_stats = {
+    "gaps": deque(maxlen=200),        # seconds between track end and next vc.play
+    "sources": {"opus": 0, "pcm": 0},  # audio sources built per playback path
+}
+
+live_sources: "weakref.WeakSet[discord.AudioSource]" = weakref.WeakSet()
+
+def ffmpeg_process_count() -> int:
+    count = 0
+    for src in list(live_sources):
+        proc = getattr(src, "_process", None)
+        if proc is not None and proc.poll() is None:
+            count += 1
+    return count
 
-    view = NowPlayingView(guild)
-    msg = await ch.send(embed=embed, view=view)
-    state.now_playing_msg = msg
+def make_source(track: Track, local_path: str | None = None) -> discord.AudioSource:
+    if local_path:
+        src, opts = local_path, {"options": "-vn"}
+    else:
+        src, opts = track.stream_url, FFMPEG_OPTS
+    # Opus (webm) -> copy the packets; anything else (m4a/aac, unknown) -> decode to PCM
+    if OPUS_PASSTHROUGH and track.codec == "opus":
+        playback_stats["sources"]["opus"] += 1
+        source = discord.FFmpegOpusAudio(src, codec="copy", **opts)
+    else:
+        playback_stats["sources"]["pcm"] += 1
+        source = discord.FFmpegPCMAudio(src, **opts)
+    live_sources.add(source)
+    return source
+
+def cancel_prefetch(state: GuildMusicState):
+    for task in (state.prefetch_task, state.refill_task):
+        if task and not task.done():
+            task.cancel()
+    state.prefetch_task = None
+    state.refill_task = None
+    if state.prefetched:
+        try:
+            state.prefetched[1].cleanup()
+        except Exception:
+            pass
+        state.prefetched = None
 
-async def play_next(guild: discord.Guild):
+async def refill_queue(guild: discord.Guild, interactive: bool = False):
+    """interactive: playback is waiting on this refill, so its extractions jump the background queue."""
     state = get_state(guild.id)
-    if state.is_playing_next:
-        return
-    state.is_playing_next = True
 
+    # a low-water refill may already be on its way; shielded, so cancelling this caller
+    # (e.g. the prefetch task) does not cancel the refill the player is waiting on too
+    if state.refill_task and not state.refill_task.done():
+        try:
+            await asyncio.shield(state.refill_task)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # the refill itself was cancelled by someone else: do our own below
+        except Exception:
+            pass
+        if state.queue:
+            return
+
+    # 1) try radio list
+    ok = await radio_fill_queue(guild, interactive=interactive)
+
+    # 2) if radio empty and autoplay enabled, pick something related to the current track
+    #    (prefetch_next calls this while the track plays, so the pick is ready in time)
+    if not ok and state.autoplay and state.current_track:
+        track = await autoplay_pick(guild.id, state.current_track, interactive)
+        if track:
+            state.queue.append(track)
+            ok = True
+
+    # 3) nothing to go on, fallback query (guarantee start)
+    if not ok:
+        try:
+            track = await ytdlp_lookup(DEFAULT_AUTOPLAY_QUERY, guild.id, interactive=interactive, source="fallback")
+            state.queue.append(track)
+        except Exception as e:
+            print(f"[refill] fallback extract fail: {e}")
+
+async def wait_played(guild: discord.Guild, started: float, seconds: float):
+    """Sleeps until `seconds` of playback have passed since `started`; paused time does not count.
+
+    Pauses are sampled every PREFETCH_POLL seconds, so the result is that accurate.
+    """
+    played, last = 0.0, started
+    while True:
+        now = time.monotonic()
+        vc = guild.voice_client
+        if not (vc and vc.is_paused()):
+            played += now - last
+        last = now
+        if played >= seconds:
+            return
+        await asyncio.sleep(min(seconds - played, PREFETCH_POLL))
+
+async def prefetch_next(guild: discord.Guild, playing: Track):
+    """Runs while `playing` plays: make sure the next track is resolved (and optionally spawned)."""
+    started = time.monotonic()  # started right after vc.play()
+    state = get_state(guild.id)
     try:
+        if state.loop:
+            return
+        if not state.queue:
+            await refill_queue(guild)
+        if not state.queue or state.current_track is not playing:
+            return
+
+        nxt = state.queue[0]
+        if not audio_cache.has(nxt.video_id):
+            await resolve_stream(nxt, guild.id, interactive=False, ahead=playing.duration or 0)
+
+        if PREFETCH_FFMPEG and playing.duration:
+            await wait_played(guild, started, playing.duration - PREFETCH_LEAD)
+            if state.current_track is playing and state.queue and state.queue[0] is nxt:
+                local = audio_cache.lookup(nxt)
+                state.prefetched = (nxt, make_source(nxt, local))
+                if not local:
+                    audio_cache.maybe_store(nxt)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"[prefetch] fail: {e}")
+
+# =========================
+# Player (one task per guild)
+# =========================
+PLAYER_IDLE = "idle"          # nothing playing, waiting for "play"
+PLAYER_STARTING = "starting"  # picking / resolving the next track
+PLAYER_PLAYING = "playing"    # a source is on the voice client
+
+class GuildPlayer:
+    """Serializes every playback transition of one guild through a command queue.
+
+    Commands: play (start if idle), skip, stop, ended (posted from the voice thread's
+    after-callback), refill. Only this task calls vc.play()/vc.stop(), so skips, stops
+    and auto-joins can no longer race each other. Each command runs as its own step
+    task: stop always, and skip while a track is starting, cancel the running step
+    instead of waiting behind a slow resolve / refill. A step that fails, times out or
+    is cancelled by anything but post() re-posts "play" with backoff while in voice.
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.status = PLAYER_IDLE
+        self._commands: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self._step: asyncio.Task | None = None
+        self._preempted = False  # set when post() cancelled the running step
+        self._play_id = 0  # "ended" from an older source is ignored
+        self._retry: asyncio.TimerHandle | None = None
+        self._retry_delay = PLAYER_RETRY_MIN
+
+    def post(self, command: str, *args):
+        preempt = command == "stop" or (command == "skip" and self.status == PLAYER_STARTING)
+        if preempt and self._step and not self._step.done():
+            self._preempted = True
+            self._step.cancel()
+        if command == "stop":
+            self._cancel_retry()
+        self._commands.put_nowait((command, args))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        self._cancel_retry()
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    def _cancel_retry(self):
+        if self._retry:
+            self._retry.cancel()
+            self._retry = None
+
+    def _schedule_retry(self):
+        """A transition failed while in voice: post "play" again later, backing off, so the guild never stays silent."""
+        guild = bot.get_guild(self.guild_id)
+        vc = guild.voice_client if guild else None
+        if self._retry or not vc or not vc.is_connected():
+            return
+        delay = self._retry_delay
+        self._retry_delay = min(delay * 2, PLAYER_RETRY_MAX)
+        print(f"[player {self.guild_id}] retrying in {delay:.1f}s")
+
+        def _fire():
+            self._retry = None
+            self.post("play")
+
+        self._retry = asyncio.get_running_loop().call_later(delay, _fire)
+
+    async def _run(self):
+        while True:
+            command, args = await self._commands.get()
+            self._preempted = False
+            self._step = asyncio.create_task(self._handle(command, *args))
+            failed = False
+            try:
+                await asyncio.wait_for(self._step, timeout=PLAYER_STEP_TIMEOUT)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise  # close(): the player itself is going away
+                if self._preempted:
+                    print(f"[player {self.guild_id}] {command} pre-empted")
+                else:
+                    print(f"[player {self.guild_id}] {command} cancelled")
+                    failed = True
+            except asyncio.TimeoutError:
+                print(f"[player {self.guild_id}] {command} timed out")
+                failed = True
+            except Exception as e:
+                print(f"[player {self.guild_id}] {command} failed: {e}")
+                failed = True
+            if self.status == PLAYER_STARTING:
+                self.status = PLAYER_IDLE
+            if failed and command != "stop" and self.status == PLAYER_IDLE:
+                self._schedule_retry()
+
+    async def _handle(self, command: str, *args):
+        guild = bot.get_guild(self.guild_id)
+        if guild is None:
+            return
+        if command == "play":
+            if self.status == PLAYER_IDLE:
+                await self._start_next(guild)
+        elif command == "ended":
+            play_id, err = args
+            if play_id != self._play_id or self.status != PLAYER_PLAYING:
+                return
+            if err:
+                print(f"[player {self.guild_id}] error: {err}")
+            get_state(self.guild_id).track_ended_at = time.monotonic()
+            self.status = PLAYER_IDLE
+            await self._start_next(guild)
+        elif command == "skip":
+            vc = guild.voice_client
+            if self.status == PLAYER_PLAYING and vc and (vc.is_playing() or vc.is_paused()):
+                vc.stop()  # -> "ended" -> next track
+            elif self.status == PLAYER_IDLE:
+                await self._start_next(guild)  # pre-empted while starting: go on with the next one
+        elif command == "stop":
+            (disconnect,) = args
+            state = get_state(self.guild_id)
+            state.queue.clear()
+            cancel_prefetch(state)
+            state.current_track = None
+            state.loop = False
+            self._play_id += 1
+            self.status = PLAYER_IDLE
+            vc = guild.voice_client
+            if vc and vc.is_connected():
+                vc.stop()
+                if disconnect:
+                    await vc.disconnect()
+        elif command == "refill":
+            maybe_refill(guild)
+            if self.status == PLAYER_IDLE:
+                await self._start_next(guild)
+
+    async def _start_next(self, guild: discord.Guild):
+        state = get_state(guild.id)
         vc = guild.voice_client
         if not vc or not vc.is_connected():
-            state.is_playing_next = False
             return
         if vc.is_playing() or vc.is_paused():
-            state.is_playing_next = False
             return
+        self.status = PLAYER_STARTING
 
         # loop current track
         if state.loop and state.current_track:
             state.queue.appendleft(state.current_track)
 
-        if not state.queue:
-            # 1) try radio list
-            ok = await radio_fill_queue(guild, count=3)
-
-            # 2) if radio empty, fallback query (guarantee start)
-            if not ok:
-                try:
-                    track = await ytdlp_extract(DEFAULT_AUTOPLAY_QUERY)
-                    state.queue.append(track)
-                    ok = True
-                except Exception as e:
-                    print(f"[play_next] fallback extract fail: {e}")
-
-            # 3) if still empty and autoplay enabled, try related from current track
-            if (not state.queue) and state.autoplay and state.current_track:
-                related = await ytdlp_related(state.current_track.webpage_url)
-                if related:
-                    state.queue.append(related)
+        prefetched = state.prefetched
+        state.prefetched = None
+        if state.prefetch_task and not state.prefetch_task.done():
+            state.prefetch_task.cancel()
 
-        if not state.queue:
-            state.is_playing_next = False
-            print("[play_next] queue empty, nothing to play")
+        try:
+            source, track = await self._pick_source(guild, state, prefetched)
+        except asyncio.CancelledError:
+            # pre-empted by stop/skip: don't leave a spawned FFmpeg behind
+            if prefetched:
+                prefetched[1].cleanup()
+            raise
+        if source is None:
+            self.status = PLAYER_IDLE
+            print("[player] queue empty, nothing to play")
             return
 
-        track = state.queue.popleft()
-        state.current_track = track
+        if prefetched and prefetched[1] is not source:
+            prefetched[1].cleanup()
 
-        source = discord.FFmpegPCMAudio(track.stream_url, **FFMPEG_OPTS)
+        if not vc.is_connected():
+            source.cleanup()
+            self.status = PLAYER_IDLE
+            return
+
+        self._play_id += 1
+        play_id = self._play_id
+        loop = asyncio.get_running_loop()
 
         def _after(err):
-            state.is_playing_next = False
-            if err:
-                print(f"[play_next] error: {err}")
-            asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop)
+            # voice thread -> hand the event to the player task
+            loop.call_soon_threadsafe(self.post, "ended", play_id, err)
 
         vc.play(source, after=_after)
-        await send_now_playing(guild, track)
+        self.status = PLAYER_PLAYING
+        self._retry_delay = PLAYER_RETRY_MIN
+        if track.video_id:
+            state.remember_played(track.video_id)
+        mark_startup("first_audio")
+        if state.track_ended_at is not None:
+            gap = time.monotonic() - state.track_ended_at
+            playback_stats["gaps"].append(gap)
+            gap_histogram.observe(gap)
+            state.track_ended_at = None
+        state.prefetch_task = asyncio.create_task(prefetch_next(guild, track))
+        get_ui(guild.id).now_playing()
+
+    async def _pick_source(self, guild: discord.Guild, state: "GuildMusicState", prefetched):
+        """Pops tracks until one yields a source; (None, None) when the queue stays empty."""
+        source = None
+        while source is None:
+            if not state.queue:
+                await refill_queue(guild, interactive=True)  # nothing is playing until this returns
+
+            if not state.queue:
+                return None, None
+
+            track = state.queue.popleft()
+            state.current_track = track
+            maybe_refill(guild)
+
+            if prefetched and prefetched[0] is track:
+                source = prefetched[1]
+                break
+            local = audio_cache.lookup(track)
+            if local:
+                source = make_source(track, local)
+                break
+            # queued lazily: the stream URL is fetched (or refreshed) only now
+            try:
+                await resolve_stream(track, guild.id)
+            except Exception as e:
+                print(f"[player] resolve fail, skipping {track.title!r}: {e}")
+                continue
+            source = make_source(track)
+            audio_cache.maybe_store(track)
+        return source, track
 
-    except Exception as e:
-        print(f"[play_next] exception: {e}")
-        state.is_playing_next = False
+players: dict[int, GuildPlayer] = {}
+
+def get_player(guild_id: int) -> GuildPlayer:
+    if guild_id not in players:
+        players[guild_id] = GuildPlayer(guild_id)
+    return players[guild_id]
+
+# =========================
+# Idle guild eviction
+# =========================
+_unsaved_settings: set[int] = set()  # evicted guilds whose GuildConfig is ahead of guild_settings
+
+def evict_idle_guilds() -> int:
+    """Drop in-memory state of guilds that are not in voice and were not touched for IDLE_EVICT_SECONDS."""
+    cutoff = time.monotonic() - IDLE_EVICT_SECONDS
+    evicted = 0
+    for gid, state in list(music_states.items()):
+        if state.last_active > cutoff or gid in always_on_guilds:
+            continue
+        guild = bot.get_guild(gid)
+        if guild and guild.voice_client:
+            continue
+        player = players.get(gid)
+        if player and player.status != PLAYER_IDLE:
+            continue
+        cancel_prefetch(state)
+        # radio position / loop only change in memory; they are saved once, here
+        cfg = guild_configs.get(gid)
+        if cfg or state.radio_pos or state.loop:
+            cfg = cfg or guild_configs.setdefault(gid, GuildConfig())
+            if (cfg.radio_pos, cfg.loop) != (state.radio_pos, state.loop):
+                cfg.radio_pos, cfg.loop = state.radio_pos, state.loop
+                _unsaved_settings.add(gid)
+        del music_states[gid]
+        player = players.pop(gid, None)
+        if player:
+            player.close()
+        radio_lists.pop(gid, None)  # reloaded lazily by load_radio_list
+        guild_uis.pop(gid, None)
+        task = _vc_join_tasks.get(gid)
+        if task and task.done():
+            del _vc_join_tasks[gid]
+        evicted += 1
+    return evicted
+
+async def save_evicted_settings():
+    """Write the radio position / loop of evicted guilds in one transaction."""
+    rows = [guild_settings_row(gid, guild_configs[gid]) for gid in _unsaved_settings if gid in guild_configs]
+    _unsaved_settings.clear()
+    if rows:
+        await database.executemany(GUILD_SETTINGS_UPSERT, rows)
+
+async def idle_evictor():
+    while True:
+        await asyncio.sleep(max(60, IDLE_EVICT_SECONDS // 4))
+        evicted = evict_idle_guilds()
+        if evicted:
+            print(f"[evict] dropped {evicted} idle guild states, {len(music_states)} left")
+        await save_evicted_settings()
+
+# =========================
+# Sessions (persist / restore playback across restarts)
+# =========================
+def session_snapshot(guild_id: int, state: GuildMusicState) -> tuple | None:
+    """(voice_channel_id, text_channel_id, radio_pos, loop, queue json) or None when not in voice."""
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    if not vc or not vc.is_connected() or not vc.channel:
+        return None
+    tracks = [state.current_track] if state.current_track else []
+    tracks.extend(state.queue)
+    # compact: stream URLs are never stored, the player re-resolves them lazily
+    queue = [
+        [t.video_id, t.title, t.duration] if t.video_id else [None, t.title, t.duration, t.webpage_url]
+        for t in tracks
+    ]
+    return (
+        vc.channel.id, state.text_channel_id, state.radio_pos, int(state.loop),
+        json.dumps(queue, ensure_ascii=False, separators=(",", ":")),
+    )
+
+def track_from_session(entry: list) -> Track:
+    vid, title, duration = entry[:3]
+    url = f"https://www.youtube.com/watch?v={vid}" if vid else entry[3]
+    return Track(title=title, webpage_url=url, video_id=vid, duration=duration)
+
+class SessionStore:
+    """Throttled write-behind of every guild's session: one transaction per interval, changed rows only."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._written: dict[int, tuple] = {}
+        self._task: asyncio.Task | None = None
+        self.flushes = 0
+
+    def start(self, stored: list[int] = ()):
+        """`stored`: guild ids that already have a row (deleted by the first flush unless active)."""
+        self._written.update((gid, ()) for gid in stored)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[sessions] flush fail: {e}")
+
+    async def flush(self):
+        current = {}
+        for gid, state in list(music_states.items()):
+            snap = session_snapshot(gid, state)
+            if snap:
+                current[gid] = snap
+        now = time.time()
+        upserts = [(gid, *snap, now) for gid, snap in current.items() if self._written.get(gid) != snap]
+        deletes = [(gid,) for gid in self._written if gid not in current]
+        if not upserts and not deletes:
+            return
+        async with database.transaction() as db:
+            if upserts:
+                await db.executemany("""
+                INSERT OR REPLACE INTO sessions
+                    (guild_id, voice_channel_id, text_channel_id, radio_pos, loop, queue, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, upserts)
+            if deletes:
+                await db.executemany("DELETE FROM sessions WHERE guild_id = ?", deletes)
+        self._written = current
+        self.flushes += 1
+
+    def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def close(self):
+        """Shutdown: last snapshot, taken while the voice clients are still connected."""
+        self.stop()
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"active": len(self._written), "flushes": self.flushes}
+
+session_store = SessionStore(SESSION_FLUSH_SECONDS)
+
+async def restore_sessions():
+    """Rejoin every guild that was playing before the restart, SESSION_RESTORE_CONCURRENCY at a time."""
+    await bot.wait_until_ready()
+    t0 = time.perf_counter()
+    cutoff = time.time() - SESSION_MAX_AGE
+    expired = await database.execute("DELETE FROM sessions WHERE updated_at <= ?", (cutoff,))
+    if expired:
+        print(f"[sessions] dropped {expired} expired sessions")
+    rows = await database.fetchall(
+        "SELECT guild_id, voice_channel_id, text_channel_id, radio_pos, loop, queue FROM sessions "
+        "WHERE updated_at > ?", (cutoff,)
+    )
+    rows = [r for r in rows if owns_guild(r[0])]
+    sem = asyncio.Semaphore(SESSION_RESTORE_CONCURRENCY)
+
+    async def _restore(gid: int, voice_id: int, text_id: int | None, radio_pos: int, loop: int, queue: str) -> bool:
+        guild = bot.get_guild(gid)
+        ch = guild.get_channel(voice_id) if guild else None
+        if not isinstance(ch, (discord.VoiceChannel, discord.StageChannel)):
+            return False
+        # nobody left to listen -> only 24/7 guilds come back
+        if gid not in always_on_guilds and not any(not m.bot for m in ch.members):
+            return False
+        async with sem:
+            state = get_state(gid)
+            state.text_channel_id = text_id or state.text_channel_id or pick_default_text_channel(guild)
+            state.radio_pos = radio_pos
+            state.loop = bool(loop)
+            if not state.queue and not state.current_track:
+                state.queue.extend(track_from_session(e) for e in json.loads(queue))
+            vc = await safe_connect(ch, guild)
+            if vc is None:
+                state.queue.clear()
+                return False
+            await start_autoplay_if_needed(guild)
+            return True
+
+    results = await asyncio.gather(*(_restore(*row) for row in rows), return_exceptions=True)
+    for res in results:
+        if isinstance(res, BaseException):
+            print(f"[sessions] restore fail: {res}")
+    restored = sum(res is True for res in results)
+    print(f"[sessions] restored {restored}/{len(rows)} guilds in {time.perf_counter() - t0:.1f}s")
+    mark_startup("sessions")
+    session_store.start([row[0] for row in rows])
 
 async def start_autoplay_if_needed(guild: discord.Guild):
     vc = guild.voice_client
     if not vc or not vc.is_connected():
         return
     if vc.is_playing() or vc.is_paused():
+        get_player(guild.id).post("refill")  # e.g. new radio entries: top up the queue
         return
     state = get_state(guild.id)
-    if state.is_playing_next:
-        return
     if state.text_channel_id is None:
         state.text_channel_id = pick_default_text_channel(guild)
-    await play_next(guild)
+    get_player(guild.id).post("play")
 
 # =========================
 # Auto-join debounce
@@ -458,23 +2444,60 @@ intents.members = True
 intents.voice_states = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-@bot.event
-async def on_ready():
-    await init_db()
-
+if SHARD_COUNT:
+    # ✅ one gateway connection per shard; SHARD_IDS limits this process to its cluster's shards
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+def command_tree_hash() -> str:
+    payload = [cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_commands_if_changed():
+    """tree.sync() hits a rate-limited global endpoint; only call it when the commands changed."""
+    key = f"command_hash:{bot.application_id}"
+    digest = command_tree_hash()
+    row = await database.fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+    if row and row[0] == digest and not FORCE_COMMAND_SYNC:
+        print("[startup] slash commands unchanged, sync skipped")
+        return
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} slash commands.")
     except Exception as e:
         print("Sync failed:", e)
+        return
+    await database.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, digest))
+
+_startup_tasks: set[asyncio.Task] = set()  # the loop only keeps weak references to tasks
+
+async def setup_hook():
+    """Runs once per process after login (on_ready fires again on every reconnect)."""
+    mark_startup("login")
+    extract_scheduler.start()  # yt-dlp import + warm-up in the extract threads
+    for coro in (warm_track_cache_from_radio(), restore_sessions()):
+        task = asyncio.create_task(coro)
+        _startup_tasks.add(task)
+        task.add_done_callback(_startup_tasks.discard)
+    if CLUSTER_INDEX == 0:  # commands are global; one cluster syncing is enough
+        await sync_commands_if_changed()
+    mark_startup("setup")
+
+bot.setup_hook = setup_hook
 
+@bot.event
+async def on_ready():
+    mark_startup("ready")
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
     print(f"[env] AUTO_VC_GUILD_ID={AUTO_VC_GUILD_ID}, AUTO_VC_CHANNEL_ID={AUTO_VC_CHANNEL_ID}")
+    if SHARD_COUNT:
+        print(f"[cluster {CLUSTER_INDEX}] shards {SHARD_IDS or 'all'} of {SHARD_COUNT}, {len(bot.guilds)} guilds")
 
     # ✅ Auto join on startup (no need anyone to join VC)
-    if AUTO_VC_GUILD_ID and AUTO_VC_CHANNEL_ID:
+    if AUTO_VC_GUILD_ID and AUTO_VC_CHANNEL_ID and owns_guild(AUTO_VC_GUILD_ID):
         guild = bot.get_guild(AUTO_VC_GUILD_ID)
         if not guild:
             print("[auto_vc] guild not found. Check AUTO_VC_GUILD_ID")
@@ -521,7 +2544,7 @@ async def on_message(message: discord.Message):
     if message.author.bot or not message.guild:
         return
 
-    music_ch_id = await get_music_channel(message.guild.id)
+    music_ch_id = get_music_channel(message.guild.id)
     if music_ch_id and message.channel.id == music_ch_id:
         query = message.content.strip()
         if not query or query.startswith("/"):
@@ -542,13 +2565,35 @@ async def on_message(message: discord.Message):
 
         state = get_state(message.guild.id)
         state.text_channel_id = message.channel.id
+        if len(state.queue) >= MAX_QUEUE:
+            try:
+                await message.channel.send(f"📛 播放清單已滿（上限 {MAX_QUEUE} 首）。", delete_after=5)
+            except Exception:
+                pass
+            return
 
         vc = await safe_connect(member.voice.channel, message.guild)
         if vc is None:
             return
 
+        if PLAYLIST_MAX and YT_PLAYLIST_RE.search(query):
+            try:
+                added, limit = await queue_playlist(message.guild, query)
+            except ExtractionCancelled:
+                return
+            except Exception as e:
+                print(f"[on_message] playlist fail: {e}")
+                added, limit = 0, PLAYLIST_MAX
+            try:
+                await message.channel.send(playlist_summary(added, limit), delete_after=8)
+            except Exception:
+                pass
+            return
+
         try:
-            track = await ytdlp_extract(query)
+            track = await ytdlp_lookup(query, message.guild.id)
+        except ExtractionCancelled:
+            return
         except Exception as e:
             print(f"[on_message] ytdlp_extract fail: {e}")
             try:
@@ -559,12 +2604,9 @@ async def on_message(message: discord.Message):
 
         state.queue.append(track)
         if not vc.is_playing() and not vc.is_paused():
-            await play_next(message.guild)
+            get_player(message.guild.id).post("play")
         else:
-            try:
-                await message.channel.send(f"➕ 已加入播放清單：**{track.title}**", delete_after=8)
-            except Exception:
-                pass
+            get_ui(message.guild.id).queued(message.channel, track.title)
 
     await bot.process_commands(message)
 
@@ -641,19 +2683,15 @@ async def checkin(interaction: discord.Interaction):
     today = utc_today_str()
     month = utc_month_str()
 
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT INTO checkins (guild_id, user_id, date, month) VALUES (?, ?, ?, ?)",
-                (guild_id, user_id, today, month),
-            )
-            await db.commit()
+    is_new = await checkin_writer.submit(guild_id, user_id, today, month)
+    if is_new:
         await interaction.followup.send(f"✅ 打卡成功：{today}", ephemeral=True)
-    except aiosqlite.IntegrityError:
+    else:
         await interaction.followup.send("你今天已經打過卡了。", ephemeral=True)
 
-@bot.tree.command(name="leaderboard", description="本月打卡前三名")
-async def leaderboard(interaction: discord.Interaction):
+@bot.tree.command(name="leaderboard", description="本月打卡排行榜")
+@app_commands.describe(top="顯示前幾名（預設 3）")
+async def leaderboard(interaction: discord.Interaction, top: app_commands.Range[int, 1, 25] = 3):
     await interaction.response.defer()
     if not interaction.guild:
         return await interaction.followup.send("請在伺服器內使用。")
@@ -661,16 +2699,13 @@ async def leaderboard(interaction: discord.Interaction):
     guild_id = interaction.guild.id
     month = utc_month_str()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT user_id, COUNT(*) as cnt
-            FROM checkins
-            WHERE guild_id = ? AND month = ?
-            GROUP BY user_id
-            ORDER BY cnt DESC
-            LIMIT 3
-        """, (guild_id, month))
-        rows = await cur.fetchall()
+    rows = await database.fetchall("""
+        SELECT user_id, count
+        FROM checkin_counts
+        WHERE guild_id = ? AND month = ?
+        ORDER BY count DESC
+        LIMIT ?
+    """, (guild_id, month, top))
 
     if not rows:
         return await interaction.followup.send(f"本月（{month}）尚無打卡紀錄。")
@@ -682,12 +2717,35 @@ async def leaderboard(interaction: discord.Interaction):
         lines.append(f"**#{i}** {name} — **{cnt}** 天")
 
     embed = discord.Embed(
-        title=f"🏆 本月打卡排行榜（{month}）TOP 3",
+        title=f"🏆 本月打卡排行榜（{month}）TOP {top}",
         description="\n".join(lines),
         color=0x2ECC71,
     )
     await interaction.followup.send(embed=embed)
 
+@bot.tree.command(name="streak", description="查看連續打卡天數")
+@app_commands.describe(member="要查詢的成員（預設自己）")
+async def streak(interaction: discord.Interaction, member: discord.Member | None = None):
+    if not interaction.guild or not interaction.user:
+        return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
+
+    target = member or interaction.user
+    row = await database.fetchone("""
+        SELECT last_date, current_streak, longest_streak FROM checkin_counts
+        WHERE guild_id = ? AND user_id = ?
+        ORDER BY last_date DESC LIMIT 1
+    """, (interaction.guild.id, target.id))
+    if not row:
+        return await interaction.response.send_message(f"{target.mention} 還沒有打卡紀錄。", ephemeral=True)
+
+    last_date, current, longest = row
+    today = dt.date.fromisoformat(utc_today_str())
+    if (today - dt.date.fromisoformat(last_date)).days > 1:
+        current = 0  # streak broken
+    await interaction.response.send_message(
+        f"🔥 {target.mention} 目前連續打卡 **{current}** 天，最長 **{longest}** 天。", ephemeral=True
+    )
+
 # =========================
 # Slash: Music controls
 # =========================
@@ -704,6 +2762,8 @@ async def play(interaction: discord.Interaction, query: str):
 
     state = get_state(interaction.guild.id)
     state.text_channel_id = interaction.channel_id
+    if len(state.queue) >= MAX_QUEUE:
+        return await interaction.followup.send(f"📛 播放清單已滿（上限 {MAX_QUEUE} 首）。")
 
     try:
         vc = await ensure_voice(interaction)
@@ -716,8 +2776,20 @@ async def play(interaction: discord.Interaction, query: str):
     if vc is None:
         return await interaction.followup.send("🎧 請先進入語音頻道，再使用 `/play`。")
 
+    if PLAYLIST_MAX and YT_PLAYLIST_RE.search(query):
+        try:
+            added, limit = await queue_playlist(interaction.guild, query)
+        except ExtractionCancelled:
+            return await interaction.followup.send("⏹️ 已取消匯入播放清單。")
+        except Exception as e:
+            print(f"[slash /play] playlist fail: {e}")
+            added, limit = 0, PLAYLIST_MAX
+        return await interaction.followup.send(playlist_summary(added, limit))
+
     try:
-        track = await ytdlp_extract(query)
+        track = await ytdlp_lookup(query, interaction.guild.id)
+    except ExtractionCancelled:
+        return await interaction.followup.send("⏹️ 已取消點歌。")
     except Exception as e:
         print(f"[slash /play] extract fail: {e}")
         return await interaction.followup.send("❌ 解析失敗：請換一個關鍵字或 URL。")
@@ -726,7 +2798,7 @@ async def play(interaction: discord.Interaction, query: str):
     await interaction.followup.send(f"➕ 已加入播放清單：**{track.title}**")
 
     if not vc.is_playing() and not vc.is_paused():
-        await play_next(interaction.guild)
+        get_player(interaction.guild.id).post("play")
 
 @bot.tree.command(name="queue", description="查看播放清單")
 async def queue_cmd(interaction: discord.Interaction):
@@ -749,6 +2821,7 @@ async def pause(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
     if vc and vc.is_connected() and vc.is_playing():
         vc.pause()
+        get_ui(interaction.guild.id).now_playing()
         return await interaction.response.send_message("⏸️ 已暫停。")
     await interaction.response.send_message("目前沒有在播放。", ephemeral=True)
 
@@ -759,6 +2832,7 @@ async def resume(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
     if vc and vc.is_connected() and vc.is_paused():
         vc.resume()
+        get_ui(interaction.guild.id).now_playing()
         return await interaction.response.send_message("▶️ 已繼續。")
     await interaction.response.send_message("目前沒有暫停中的播放。", ephemeral=True)
 
@@ -769,9 +2843,7 @@ async def skip(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
     if not vc or not vc.is_connected() or (not vc.is_playing() and not vc.is_paused()):
         return await interaction.response.send_message("目前沒有在播放。", ephemeral=True)
-    state = get_state(interaction.guild.id)
-    state.is_playing_next = False
-    vc.stop()
+    get_player(interaction.guild.id).post("skip")
     await interaction.response.send_message("⏭️ 已跳過。")
 
 @bot.tree.command(name="loop", description="單曲循環開關")
@@ -780,6 +2852,7 @@ async def loop_cmd(interaction: discord.Interaction):
         return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
     state = get_state(interaction.guild.id)
     state.loop = not state.loop
+    get_ui(interaction.guild.id).now_playing()
     status = "🔁 已開啟單曲循環" if state.loop else "🔁 已關閉單曲循環"
     await interaction.response.send_message(status)
 
@@ -789,6 +2862,8 @@ async def autoplay_cmd(interaction: discord.Interaction):
         return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
     state = get_state(interaction.guild.id)
     state.autoplay = not state.autoplay
+    await save_guild_settings(interaction.guild.id, autoplay=state.autoplay)
+    get_ui(interaction.guild.id).now_playing()
     status = "✅ 已開啟 Autoplay" if state.autoplay else "❌ 已關閉 Autoplay"
     await interaction.response.send_message(status)
 
@@ -798,6 +2873,8 @@ async def clear_queue(interaction: discord.Interaction):
         return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
     state = get_state(interaction.guild.id)
     state.queue.clear()
+    extract_scheduler.cancel_guild(interaction.guild.id)
+    cancel_prefetch(state)
     await interaction.response.send_message("🧹 播放清單已清空。")
 
 @bot.tree.command(name="stop", description="停止播放並退出語音")
@@ -807,26 +2884,11 @@ async def stop(interaction: discord.Interaction):
 
     state = get_state(interaction.guild.id)
     state.queue.clear()
-    state.is_playing_next = False
-    state.current_track = None
-    state.loop = False
-
-    vc = interaction.guild.voice_client
-    if vc and vc.is_connected():
-        try:
-            vc.stop()
-            await vc.disconnect()
-        except Exception:
-            pass
-
-    if state.now_playing_msg:
-        try:
-            await state.now_playing_msg.edit(view=None)
-        except Exception:
-            pass
-        state.now_playing_msg = None
+    extract_scheduler.cancel_guild(interaction.guild.id)
+    get_player(interaction.guild.id).post("stop", True)
 
     await interaction.response.send_message("⏹️ 已停止並退出語音。")
+    await get_ui(interaction.guild.id).close(interaction.guild)
 
 # =========================
 # Slash: 24/7
@@ -839,7 +2901,7 @@ async def always_on(interaction: discord.Interaction, mode: str):
 
     mode = mode.lower().strip()
     if mode in ("on", "開", "開啟", "true", "1"):
-        always_on_guilds.add(interaction.guild.id)
+        await save_guild_settings(interaction.guild.id, always_on=True)
         await interaction.response.send_message("✅ 已開啟 24/7：語音沒人也會持續播放、不自動退出。")
         state = get_state(interaction.guild.id)
         state.text_channel_id = interaction.channel_id
@@ -850,7 +2912,7 @@ async def always_on(interaction: discord.Interaction, mode: str):
         except Exception:
             await start_autoplay_if_needed(interaction.guild)
     elif mode in ("off", "關", "關閉", "false", "0"):
-        always_on_guilds.discard(interaction.guild.id)
+        await save_guild_settings(interaction.guild.id, always_on=False)
         await interaction.response.send_message("✅ 已關閉 24/7：語音沒人會自動退出。")
     else:
         await interaction.response.send_message("請輸入 on（開啟）或 off（關閉）。", ephemeral=True)
@@ -865,12 +2927,7 @@ async def radio_add(interaction: discord.Interaction, query: str):
         return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
 
     guild_id = interaction.guild.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COALESCE(MAX(idx), -1) FROM radio WHERE guild_id = ?", (guild_id,))
-        (mx,) = await cur.fetchone()
-        idx = int(mx) + 1
-        await db.execute("INSERT INTO radio (guild_id, idx, query) VALUES (?, ?, ?)", (guild_id, idx, query))
-        await db.commit()
+    await radio_add_many(guild_id, [query])
 
     await interaction.response.send_message(f"✅ 已加入電台清單：`{query}`")
 
@@ -882,6 +2939,58 @@ async def radio_add(interaction: discord.Interaction, query: str):
     except Exception:
         pass
 
+@bot.tree.command(name="radio_import", description="一次加入多筆電台（以換行、; 或 | 分隔）")
+@app_commands.describe(queries="多個 YouTube URL 或關鍵字，用 ; 或 | 分隔")
+async def radio_import(interaction: discord.Interaction, queries: str):
+    if not interaction.guild:
+        return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
+
+    items = [q.strip() for q in re.split(r"[\n;|]", queries) if q.strip()]
+    if not items:
+        return await interaction.response.send_message("沒有可加入的項目。", ephemeral=True)
+
+    radio = await radio_add_many(interaction.guild.id, items)
+    await interaction.response.send_message(f"✅ 已加入 **{len(items)}** 筆，電台清單共 {len(radio)} 筆。")
+
+    state = get_state(interaction.guild.id)
+    state.text_channel_id = interaction.channel_id
+    try:
+        await start_autoplay_if_needed(interaction.guild)
+    except Exception:
+        pass
+
+@bot.tree.command(name="radio_remove", description="從電台清單移除一筆（編號見 /radio_list）")
+@app_commands.describe(index="要移除的編號")
+async def radio_remove(interaction: discord.Interaction, index: int):
+    if not interaction.guild:
+        return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
+
+    radio = await load_radio_list(interaction.guild.id)
+    if not 1 <= index <= len(radio):
+        return await interaction.response.send_message(f"編號需在 1 到 {len(radio)} 之間。", ephemeral=True)
+
+    removed = await radio_remove_at(interaction.guild.id, index - 1)
+    if removed is None:  # list changed underneath us
+        radio = await load_radio_list(interaction.guild.id)
+        return await interaction.response.send_message(f"編號需在 1 到 {len(radio)} 之間。", ephemeral=True)
+    await interaction.response.send_message(f"🗑️ 已移除：`{removed}`", ephemeral=True)
+
+@bot.tree.command(name="radio_move", description="調整電台清單順序")
+@app_commands.describe(src="原本的編號", dst="移動到的編號")
+async def radio_move_cmd(interaction: discord.Interaction, src: int, dst: int):
+    if not interaction.guild:
+        return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
+
+    radio = await load_radio_list(interaction.guild.id)
+    if not (1 <= src <= len(radio) and 1 <= dst <= len(radio)):
+        return await interaction.response.send_message(f"編號需在 1 到 {len(radio)} 之間。", ephemeral=True)
+
+    item = await radio_move(interaction.guild.id, src - 1, dst - 1)
+    if item is None:  # list changed underneath us
+        radio = await load_radio_list(interaction.guild.id)
+        return await interaction.response.send_message(f"編號需在 1 到 {len(radio)} 之間。", ephemeral=True)
+    await interaction.response.send_message(f"↕️ `{item}` 已移到第 {dst} 筆。", ephemeral=True)
+
 @bot.tree.command(name="radio_list", description="查看電台清單")
 async def radio_list(interaction: discord.Interaction):
     if not interaction.guild:
@@ -895,14 +3004,23 @@ async def radio_list(interaction: discord.Interaction):
     more = f"\n... 還有 {len(radio)-15} 筆" if len(radio) > 15 else ""
     await interaction.response.send_message("📻 電台清單：\n" + "\n".join(lines) + more, ephemeral=True)
 
+@bot.tree.command(name="radio_batch", description="設定電台每次補充的歌曲數（長時間 24/7 可調大）")
+@app_commands.describe(size="每次補充幾首（1-20）")
+async def radio_batch(interaction: discord.Interaction, size: app_commands.Range[int, 1, 20]):
+    if not interaction.guild:
+        return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
+
+    state = get_state(interaction.guild.id)
+    state.radio_batch = size
+    await save_guild_settings(interaction.guild.id, radio_batch=size)
+    await interaction.response.send_message(f"✅ 電台每次補充 **{size}** 首。", ephemeral=True)
+
 @bot.tree.command(name="radio_clear", description="清空電台清單")
 async def radio_clear(interaction: discord.Interaction):
     if not interaction.guild:
         return await interaction.response.send_message("請在伺服器內使用。", ephemeral=True)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM radio WHERE guild_id = ?", (interaction.guild.id,))
-        await db.commit()
+    await radio_replace(interaction.guild.id, ())
 
     state = get_state(interaction.guild.id)
     state.radio_pos = 0
@@ -925,7 +3043,10 @@ async def help_cmd(interaction: discord.Interaction):
     )
     embed.add_field(
         name="📻 電台",
-        value="`/radio_add` 加入　`/radio_list` 查看　`/radio_clear` 清空",
+        value=(
+            "`/radio_add` 加入　`/radio_import` 批次加入　`/radio_list` 查看\n"
+            "`/radio_remove` 移除　`/radio_move` 排序　`/radio_clear` 清空　`/radio_batch` 補充數量"
+        ),
         inline=False
     )
     embed.add_field(
@@ -940,10 +3061,72 @@ async def help_cmd(interaction: discord.Interaction):
 # =========================
 from aiohttp import web as aio_web
 
+def gap_summary() -> dict:
+    gaps = sorted(playback_stats["gaps"])
+    if not gaps:
+        return {"count": 0}
+    return {
+        "count": len(gaps),
+        "last": round(playback_stats["gaps"][-1], 3),
+        "p50": round(gaps[len(gaps) // 2], 3),
+        "p95": round(gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))], 3),
+    }
+
+def render_metrics() -> str:
+    lines = []
+
+    def gauge(name: str, doc: str, samples, kind: str = "gauge"):
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} {kind}")
+        if isinstance(samples, dict):
+            for labels, value in samples.items():
+                lines.append(f"{name}{{{labels}}} {value}")
+        else:
+            lines.append(f"{name} {samples}")
+
+    gauge("musicbot_extract_pending", "yt-dlp jobs waiting for a worker", extract_scheduler.pending())
+    gauge("musicbot_extract_running", "yt-dlp jobs running", len(extract_scheduler._running))
+    gauge("musicbot_voice_clients", "Connected voice clients", len(bot.voice_clients))
+    gauge("musicbot_ffmpeg_processes", "Live FFmpeg subprocesses", ffmpeg_process_count())
+    gauge("musicbot_guild_states", "Guilds with in-memory music state", len(music_states))
+    gauge("musicbot_queue_length", "Queued tracks per guild",
+          {f'guild="{gid}"': len(st.queue) for gid, st in music_states.items() if st.queue})
+    cache = extract_cache.stats()
+    gauge("musicbot_extract_cache_total", "Extraction cache lookups by result",
+          {f'result="{k}"': cache[k] for k in ("hits", "misses", "refreshes", "evictions", "coalesced")}, "counter")
+    gauge("musicbot_audio_sources_total", "Audio sources built by playback path",
+          {f'path="{k}"': v for k, v in playback_stats["sources"].items()}, "counter")
+    gauge("musicbot_audio_cache_bytes", "Bytes in the on-disk audio cache", audio_cache.total_bytes)
+    gauge("musicbot_ui_messages_total", "Now-playing / notice writes and the updates merged away",
+          {f'kind="{k}"': v for k, v in ui_stats.items()}, "counter")
+    gauge("musicbot_startup_seconds", "Seconds from process start to each startup phase",
+          {f'phase="{k}"': v for k, v in startup_phases.items()})
+    gauge("musicbot_checkin_batches_total", "Check-in write-behind transactions", checkin_writer.batches, "counter")
+    for hist in (extract_latency, gap_histogram, db_latency, loop_lag):
+        lines.extend(hist.render())
+    return "\n".join(lines) + "\n"
+
 async def _keepalive_server():
-    port = int(os.getenv("PORT", "10000"))
+    port = int(os.getenv("PORT", "10000")) + CLUSTER_INDEX  # cluster 0 keeps the platform's port
     app = aio_web.Application()
     app.router.add_get("/", lambda r: aio_web.Response(text="OK"))
+    app.router.add_get("/metrics", lambda r: aio_web.Response(
+        text=render_metrics(), content_type="text/plain", charset="utf-8"
+    ))
+    app.router.add_get("/stats", lambda r: aio_web.json_response({
+        "extract_cache": extract_cache.stats(),
+        "ydl_pool": ydl_pool_stats,
+        "extract_pending": extract_scheduler.pending(),
+        "inter_track_gap_s": gap_summary(),
+        "audio_cache": audio_cache.stats(),
+        "related_cache": related_cache.stats(),
+        "ui": ui_stats,
+        "sessions": session_store.stats(),
+        "sources": playback_stats["sources"],
+        "startup_s": startup_phases,
+        "cluster": {"index": CLUSTER_INDEX, "shards": SHARD_IDS, "shard_count": SHARD_COUNT,
+                    "guilds": len(bot.guilds)},
+    }))
     runner = aio_web.AppRunner(app)
     await runner.setup()
     site = aio_web.TCPSite(runner, "0.0.0.0", port)
@@ -951,10 +3134,112 @@ async def _keepalive_server():
     print(f"[keepalive] HTTP server running on port {port}")
 
 async def main():
+    mark_startup("imports")
+    await database.start()
+    await init_db()
+    await load_guild_configs()
+    await audio_cache.load()
+    mark_startup("db")
     await _keepalive_server()
-    await bot.start(TOKEN)
+    mark_startup("http")
+    background = [asyncio.create_task(monitor_loop_lag())]
+    if IDLE_EVICT_SECONDS:
+        background.append(asyncio.create_task(idle_evictor()))
+
+    async def shutdown():
+        try:
+            await session_store.close()
+        except Exception as e:
+            print(f"[sessions] final flush fail: {e}")
+        await bot.close()
+
+    # deploys stop us with SIGINT (fly.io's default kill_signal) or SIGTERM (docker, the
+    # cluster launcher): save sessions before the voice clients go away. Flushing in the
+    # finally below would be too late, it would see every guild disconnected.
+    loop = asyncio.get_running_loop()
+    shutdown_task: list[asyncio.Task] = []  # held here: this task writes the final snapshot
+
+    def _on_signal():
+        if not shutdown_task:  # a second Ctrl-C does not start another flush
+            shutdown_task.append(asyncio.create_task(shutdown()))
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, _on_signal)
+        except NotImplementedError:
+            pass
+    try:
+        await bot.start(TOKEN)
+    finally:
+        for task in background + list(_startup_tasks):
+            task.cancel()
+        session_store.stop()
+        await checkin_writer.close()
+        await audio_cache.close()
+        await save_evicted_settings()
+        await database.close()
+
+# =========================
+# Cluster launcher (CLUSTER_COUNT > 1)
+# =========================
+CLUSTER_RESTART_DELAY = 5.0
+
+async def prepare_db():
+    """Create / migrate the schema once, before several processes open the file."""
+    await database.start()
+    try:
+        await init_db()
+    finally:
+        await database.close()
+
+def run_launcher():
+    """Spawn one bot process per cluster (each with its own SHARD_IDS) and restart any that dies."""
+    import subprocess
+    import sys
+
+    if SHARD_COUNT < CLUSTER_COUNT:
+        raise RuntimeError("SHARD_COUNT must be >= CLUSTER_COUNT")
+    asyncio.run(prepare_db())
+
+    procs: dict[int, subprocess.Popen] = {}
+
+    def spawn(index: int):
+        env = dict(
+            os.environ,
+            CLUSTER_INDEX=str(index),
+            SHARD_COUNT=str(SHARD_COUNT),
+            SHARD_IDS=",".join(map(str, cluster_shards(index))),
+        )
+        procs[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        print(f"[launcher] cluster {index} pid={procs[index].pid} shards={env['SHARD_IDS']}")
+
+    def shutdown(*_):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        for i in range(CLUSTER_COUNT):
+            spawn(i)
+        while True:
+            time.sleep(CLUSTER_RESTART_DELAY)
+            for i, proc in list(procs.items()):
+                if proc.poll() is not None:
+                    print(f"[launcher] cluster {i} exited with {proc.returncode}, restarting")
+                    spawn(i)
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
 if __name__ == "__main__":
     if not TOKEN:
         raise RuntimeError("DISCORD_TOKEN not set in .env")
-    asyncio.run(main())
\ No newline at end of file
+    if CLUSTER_COUNT > 1 and "CLUSTER_INDEX" not in os.environ:
+        run_launcher()
+    else:
+        asyncio.run(main())
\ No newline at end of file